@@ -0,0 +1,201 @@
+"""Headless batch mode for closing files; needs no display and never imports Qt.
+
+    python batch.py cierres/ otro.json -o procesados/ --dia 101 --semana 102
+
+Each file is loaded, filtered to the configured id_form values (the filter
+of the editor's ids dialog), regrouped, checked for duplicate codes and,
+with -o, written to that directory keeping its original structure. Ids
+not given on the command line come from the file's own cod_fechas.
+
+Files are spread over a process pool (--jobs, one file per task) and the
+per-file reports are folded into one summary. Inputs sharing a file name
+keep their path below their common directory inside the output directory,
+or get a suffix when they have none.
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Dict, Optional
+from core import PERIODS, load_closing_file, extract_global_ids, apply_global_ids, filter_by_global_ids, write_closing_file, classify_period, DuplicateIndex, SourceIndex, PeriodIndex, GroupIndex
+
+INPUT_EXTENSIONS = (".json", ".jsonl", ".txt")
+
+def collect_inputs(paths: List[str]) -> List[str]:
+    # Directories contribute their closing files, in name order; a file named twice is processed once
+    files = []
+    seen = set()
+    for p in paths:
+        if os.path.isdir(p):
+            found = [os.path.join(p, name) for name in sorted(os.listdir(p)) if name.lower().endswith(INPUT_EXTENSIONS)]
+        else:
+            found = [p]
+        for f in found:
+            key = os.path.abspath(f)
+            if key not in seen:
+                seen.add(key)
+                files.append(f)
+    return files
+
+def output_names(files: List[str]) -> Dict[str, str]:
+    """Name of each input's output inside the output directory.
+
+    That is the file name, unless several inputs share it: those keep
+    their path below the directory they have in common or, when there is
+    none (different drives), get a suffix from a hash of their directory.
+    """
+    by_name: Dict[str, List[str]] = {}
+    for path in files:
+        by_name.setdefault(os.path.basename(path), []).append(path)
+    names = {}
+    for name, group in by_name.items():
+        if len(group) == 1:
+            names[group[0]] = name
+            continue
+        dirs = [os.path.dirname(os.path.abspath(p)) for p in group]
+        try:
+            common = os.path.commonpath(dirs)
+        except ValueError:
+            stem, ext = os.path.splitext(name)
+            for p, d in zip(group, dirs):
+                names[p] = f"{stem}-{hashlib.blake2b(d.encode('utf-8'), digest_size=4).hexdigest()}{ext}"
+            continue
+        for p in group:
+            names[p] = os.path.relpath(os.path.abspath(p), common)
+    return names
+
+def process_file(path: str, out_path: Optional[str], ids_override: Dict[str, Optional[int]], flat: bool = False) -> Dict:
+    """Load, filter, check and optionally write one file; returns its report."""
+    root, items, paths, jsonl = load_closing_file(path)
+    ids = extract_global_ids(root)
+    ids.update({k: v for k, v in ids_override.items() if v is not None})
+    periods = PeriodIndex(lambda d: classify_period(d, ids))
+    periods.rebuild(items)
+    sources = SourceIndex()
+    sources.build(root, items, paths, [periods.bucket_of(d) for d in items])
+    # With no ids at all the filter would drop everything, so it is skipped
+    if any(v is not None for v in ids.values()):
+        kept = filter_by_global_ids(items, ids, sources)
+    else:
+        kept = items
+    groups = GroupIndex(periods)
+    groups.rebuild(kept)
+    dups = DuplicateIndex()
+    dups.rebuild(kept)
+    if out_path:
+        if flat or not sources.can_patch():
+            write_closing_file(out_path, [d.to_json() for d in kept])
+        else:
+            apply_global_ids(root, ids)
+            sources.patch()
+            write_closing_file(out_path, root, jsonl)
+    return {
+        "file": path,
+        "output": out_path,
+        "items": len(items),
+        "kept": len(kept),
+        "groups": len(groups.groups),
+        "duplicates": {code: len(bucket) for code, bucket in dups.by_code.items() if len(bucket) > 1},
+        "missing_ids": [p for p in PERIODS if ids.get(p) is None],
+    }
+
+def output_path(path: str, out_dir: Optional[str], name: Optional[str] = None) -> Optional[str]:
+    if not out_dir:
+        return None
+    out = os.path.join(out_dir, name or os.path.basename(path))
+    if os.path.abspath(out) == os.path.abspath(path):
+        raise ValueError("La salida coincide con el archivo de entrada")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    return out
+
+def run_file(path: str, out_dir: Optional[str], ids: Dict[str, Optional[int]], flat: bool, name: Optional[str] = None) -> Dict:
+    # Pool task: errors become part of the report so one bad file does not stop the batch
+    try:
+        return process_file(path, output_path(path, out_dir, name), ids, flat)
+    except Exception as e:
+        return {"file": path, "error": str(e)}
+
+def run_batch(files: List[str], out_dir: Optional[str], ids: Dict[str, Optional[int]], flat: bool = False, jobs: int = 1, on_report=None) -> List[Dict]:
+    """Process files, jobs at a time; reports come back in input order."""
+    names = output_names(files)
+    if jobs <= 1 or len(files) <= 1:
+        reports = []
+        for path in files:
+            reports.append(run_file(path, out_dir, ids, flat, names[path]))
+            if on_report:
+                on_report(reports[-1])
+        return reports
+    by_path: Dict[str, Dict] = {}
+    with ProcessPoolExecutor(max_workers=min(jobs, len(files))) as pool:
+        futures = [pool.submit(run_file, path, out_dir, ids, flat, names[path]) for path in files]
+        for fut in as_completed(futures):
+            rep = fut.result()
+            by_path[rep["file"]] = rep
+            if on_report:
+                on_report(rep)
+    return [by_path[path] for path in files]
+
+def summarize(reports: List[Dict]) -> Dict:
+    ok = [r for r in reports if "error" not in r]
+    duplicate_codes: Dict[str, List[str]] = {}
+    for r in ok:
+        for code in r["duplicates"]:
+            duplicate_codes.setdefault(code, []).append(r["file"])
+    missing_ids = {p: [r["file"] for r in ok if p in r["missing_ids"]] for p in PERIODS}
+    return {
+        "files": len(reports),
+        "failed": len(reports) - len(ok),
+        "items": sum(r["items"] for r in ok),
+        "kept": sum(r["kept"] for r in ok),
+        "groups": sum(r["groups"] for r in ok),
+        "duplicate_codes": duplicate_codes,
+        "missing_ids": {p: files for p, files in missing_ids.items() if files},
+    }
+
+def format_summary(summary: Dict) -> str:
+    lines = [
+        f"Archivos: {summary['files']} ({summary['failed']} con error)",
+        f"Items: {summary['kept']}/{summary['items']} retenidos en {summary['groups']} grupos",
+        f"Códigos duplicados: {len(summary['duplicate_codes'])}",
+    ]
+    for p, files in summary["missing_ids"].items():
+        lines.append(f"Sin id de {p}: {len(files)} archivos")
+    return "\n".join(lines)
+
+def format_report(rep: Dict) -> str:
+    if "error" in rep:
+        return f"{rep['file']}: ERROR {rep['error']}"
+    line = f"{rep['file']}: {rep['kept']}/{rep['items']} items, {len(rep['duplicates'])} códigos duplicados"
+    if rep["missing_ids"]:
+        line += f", sin id: {', '.join(rep['missing_ids'])}"
+    return line
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Procesa archivos de cierre sin interfaz gráfica.")
+    ap.add_argument("inputs", nargs="+", help="archivos JSON/JSONL o directorios")
+    ap.add_argument("-o", "--out-dir", help="directorio de salida; sin él solo se reporta")
+    for p in PERIODS:
+        ap.add_argument(f"--{p}", type=int, help=f"id_form de {p}")
+    ap.add_argument("--flat", action="store_true", help="guardar solo la lista de items")
+    ap.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="procesos en paralelo (por defecto, uno por núcleo)")
+    ap.add_argument("--report", help="escribe los reportes y el resumen en este archivo JSON")
+    return ap.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    ids = {p: getattr(args, p) for p in PERIODS}
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+    files = collect_inputs(args.inputs)
+    reports = run_batch(files, args.out_dir, ids, args.flat, args.jobs, lambda rep: print(format_report(rep), flush=True))
+    summary = summarize(reports)
+    print(format_summary(summary))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"files": reports, "summary": summary}, f, ensure_ascii=False, indent=2)
+    return 1 if summary["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+"""Benchmarks for the editor's hot paths, run headless on Qt's offscreen platform.
+
+    python bench.py --sizes 1000 10000 100000 --json antes.json
+    python bench.py --sizes 1000 10000 100000 --compare antes.json
+
+For each size a synthetic datosAG/formularioC document is generated (same
+seed, so runs are comparable), loaded through on_load_json and then the
+other operations are timed on the loaded editor. The parse cache and the
+journals go to the work directory: load_cold always parses the file,
+load_warm opens it again, from the cache when the file is big enough. Dialogs are answered
+automatically. The table goes to bench_output.txt and, with --json, the raw
+numbers to a file that a later run can --compare against.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+from typing import List, Dict, Optional
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PySide6.QtWidgets import QApplication, QDialog, QFileDialog, QMessageBox
+
+import main as editor
+from core import cache_path
+
+SIZES = (1000, 10000, 100000, 1000000)
+OPS = ("load_cold", "load_warm", "render_from_items", "update_duplicates", "search", "edit", "insert_row", "undo", "save")
+GRID_COLS = 20
+_IDS = (("d", "CD", "DIA", 101), ("s", "CS", "SEMANA", 102), ("m", "CM", "MES", 103), ("a", "CA", "AÑO", 104))
+
+def generate(n: int, path: str, seed: int = 1):
+    """Write a closing file with n items spread evenly over the four periods."""
+    rnd = random.Random(seed)
+    groups = []
+    for tipo, pref, sfx, id_form in _IDS:
+        rows = []
+        for i in range(n // len(_IDS)):
+            r, c = divmod(i, GRID_COLS)
+            # About one code in fifty is repeated, so duplicate tracking has work to do
+            code = f"{pref}{rnd.randrange(i + 1):06d}" if i % 50 == 0 else f"{pref}{i:06d}"
+            rows.append({"id_form": id_form, "label": f"CONCEPTO {i} {sfx}", "codigo": code,
+                         "tipo": 1, "deci": 0, "posicion": f"{r}:{c}", "valor": str(rnd.randrange(10 ** 6))})
+        groups.append(rows)
+    doc = {
+        "formularioC": [{"nombre": "bench", "cod_fechas": [{"tipo_val": t, "id_form": i} for t, _, _, i in _IDS]}],
+        "datosAG": groups,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(doc, f, ensure_ascii=False)
+
+def answer_dialogs(open_path: str, save_path: str):
+    QFileDialog.getOpenFileName = staticmethod(lambda *a, **k: (open_path, ""))
+    QFileDialog.getSaveFileName = staticmethod(lambda *a, **k: (save_path, ""))
+    QMessageBox.information = staticmethod(lambda *a, **k: None)
+    QMessageBox.critical = staticmethod(lambda *a, **k: None)
+    QDialog.exec = lambda self: QDialog.Accepted
+
+def wait_idle(app: QApplication, w: editor.GridEditor):
+    # Background work reports back through queued signals
+    while w.busy:
+        app.processEvents()
+        time.sleep(0.001)
+    app.processEvents()
+
+def bench_size(app: QApplication, n: int, workdir: str) -> Dict[str, float]:
+    src = os.path.join(workdir, f"bench_{n}.json")
+    if not os.path.exists(src):
+        generate(n, src)
+    answer_dialogs(src, os.path.join(workdir, f"bench_{n}_out.json"))
+    w = editor.GridEditor()
+    times: Dict[str, float] = {}
+    def timed(op, fn):
+        t = time.perf_counter()
+        fn()
+        times[op] = time.perf_counter() - t
+    def load(ed):
+        ed.on_load_json()
+        wait_idle(app, ed)
+    def load_cold():
+        # Left over from the previous repeat, the cache would make this a cached read
+        if os.path.exists(cache_path(src)):
+            os.remove(cache_path(src))
+        load(w)
+    def search():
+        # Typing a query one key at a time, as the debounce would deliver it at worst
+        query = "concepto 12"
+        for k in range(1, len(query) + 1):
+            w.on_search_changed(query[:k])
+        w.on_search_changed("")
+    def edit():
+        w.on_cell_changed_tab(w.current_period, 1, 1, "CD999999")
+    def insert_row():
+        w.select_cell(1, 1)
+        w.on_insert_row()
+    def save():
+        w.on_save_json()
+        wait_idle(app, w)
+    timed("load_cold", load_cold)
+    if len(w.items) == 0:
+        raise RuntimeError(f"{src}: no se cargaron items")
+    timed("render_from_items", w.render_from_items)
+    timed("update_duplicates", w.update_duplicates)
+    timed("search", search)
+    timed("edit", edit)
+    timed("insert_row", insert_row)
+    timed("undo", w.undo)
+    timed("save", save)
+    w.close()
+    w.deleteLater()
+    app.processEvents()
+    # A fresh editor, so the file is read again rather than switched to
+    w = editor.GridEditor()
+    timed("load_warm", lambda: load(w))
+    w.close()
+    w.deleteLater()
+    app.processEvents()
+    return times
+
+def git_revision() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+def format_table(results: Dict[str, Dict[str, float]], baseline: Optional[Dict[str, Dict[str, float]]] = None) -> str:
+    sizes = list(results)
+    lines = ["operación".ljust(20) + "".join(f"{s:>16}" for s in sizes)]
+    for op in OPS:
+        row = op.ljust(20)
+        for s in sizes:
+            cell = f"{results[s][op] * 1000:.1f} ms"
+            old = (baseline or {}).get(s, {}).get(op)
+            if old:
+                cell += f" {results[s][op] / old:4.2f}x"
+            row += cell.rjust(16)
+        lines.append(row)
+    return "\n".join(lines)
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Mide las operaciones principales del editor sin interfaz.")
+    ap.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="cantidades de items a medir")
+    ap.add_argument("--repeat", type=int, default=3, help="repeticiones por tamaño; se toma la mejor")
+    ap.add_argument("--workdir", help="directorio para los documentos generados (se reutilizan)")
+    ap.add_argument("--output", default="bench_output.txt", help="archivo del reporte de texto")
+    ap.add_argument("--json", help="guarda los tiempos en este archivo JSON")
+    ap.add_argument("--compare", help="JSON de una corrida anterior para mostrar la proporción")
+    return ap.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    app = QApplication.instance() or QApplication([])
+    workdir = args.workdir or tempfile.mkdtemp(prefix="cierres_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    # Keeps the user's own cache out of the numbers, and the bench files out of it
+    os.environ["CIERRESMAKER_CACHE_DIR"] = os.path.join(workdir, "cache")
+    results: Dict[str, Dict[str, float]] = {}
+    for n in args.sizes:
+        runs = [bench_size(app, n, workdir) for _ in range(max(1, args.repeat))]
+        results[str(n)] = {op: min(r[op] for r in runs) for op in OPS}
+        print(f"{n} items: " + ", ".join(f"{op} {results[str(n)][op] * 1000:.1f} ms" for op in OPS), flush=True)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    revision = git_revision()
+    header = f"Benchmark {time.strftime('%Y-%m-%d %H:%M')} revisión {revision or '?'} (mejor de {args.repeat})"
+    if args.compare:
+        header += f", proporción contra {args.compare}"
+    report = header + "\n" + format_table(results, baseline) + "\n"
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(report)
+    print(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"revision": revision, "repeat": args.repeat, "results": results}, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
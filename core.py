@@ -0,0 +1,1696 @@
+"""Qt-free core of Cierres Maker: cell items, the streaming closing-file
+reader, the editing indexes and the undo history.
+
+The editor (main.py) and the batch runner (batch.py) both build on it.
+"""
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import struct
+import zlib
+import pickle
+import hashlib
+import operator
+import bisect
+import threading
+import functools
+from collections import deque, Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import List, Dict, Optional, Tuple
+
+CELL_FIELDS = ("id_form", "label", "codigo", "tipo", "deci", "posicion", "valor")
+
+@dataclass
+class CellItem:
+    # Slotted so large forms don't pay for a per-item __dict__
+    __slots__ = CELL_FIELDS
+    id_form: int
+    label: str
+    codigo: str
+    tipo: int
+    deci: int
+    posicion: Tuple[int, int]
+    valor: str
+
+    def __reduce__(self):
+        # Pickled by value (packed workspace documents); strings and positions are shared again on load
+        return _restore_item, (self.id_form, self.label, self.codigo, self.tipo, self.deci, self.posicion, self.valor)
+
+    def to_json(self) -> Dict:
+        # Positions are only formatted as "r:c" at the file boundary
+        out = {f: getattr(self, f) for f in CELL_FIELDS}
+        out["posicion"] = fmt_pos(*self.posicion)
+        return out
+
+_POS_CACHE: Dict[Tuple[int, int], Tuple[int, int]] = {}
+
+def intern_pos(r: int, c: int) -> Tuple[int, int]:
+    # Cells at the same position in the four periods share one tuple
+    key = (r, c)
+    return _POS_CACHE.setdefault(key, key)
+
+def _restore_item(id_form, label, codigo, tipo, deci, posicion, valor) -> CellItem:
+    return CellItem(id_form, sys.intern(label), sys.intern(codigo), tipo, deci, _POS_CACHE.setdefault(posicion, posicion), sys.intern(valor))
+
+def parse_pos(pos: str) -> Tuple[int, int]:
+    r, c = pos.split(":")
+    return intern_pos(int(r), int(c))
+
+def fmt_pos(r: int, c: int) -> str:
+    return f"{r}:{c}"
+
+def col_name(idx: int) -> str:
+    s = ""
+    x = idx
+    while True:
+        s = chr(ord('A') + (x % 26)) + s
+        x = x // 26 - 1
+        if x < 0:
+            break
+    return s
+
+def norm_code(code: str) -> str:
+    return code.strip().upper() if code else ""
+
+_JSON_STR = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+_FLAT_OBJ = r'\{[^{}\[\]"]*(?:' + _JSON_STR + r'[^{}\[\]"]*)*\}'
+# "flat" is a run of sibling objects without nested containers (cell rows).
+# Matched on raw bytes: JSON structure is ASCII and UTF-8 never reuses ASCII
+# bytes, so tokens keep exact byte offsets into the file.
+_JSON_TOKEN = re.compile((
+    r'\s*(?:'
+    r'(?P<flat>' + _FLAT_OBJ + r'(?:\s*,\s*' + _FLAT_OBJ + r')*)'
+    r'|(?P<str>' + _JSON_STR + r')'
+    r'|(?P<punct>[{}\[\]:,])'
+    r'|(?P<scalar>[^\s{}\[\]:,"]+)'
+    r'|(?P<open_str>")'
+    r')').encode())
+_FLAT_ONE = re.compile(_FLAT_OBJ.encode())
+# What a container accepts next: a value or its end, a value, a comma or its end, a key, a colon
+_OPEN, _VALUE, _NEXT, _KEY, _COLON = range(5)
+# Path (with the leading doc index) of the only subtree the editor reads besides rows
+_KEEP_PATH = (0, "formularioC", 0, "cod_fechas")
+# select() tells a datosAG document by this container, so it stays a list even without rows
+_AG_PATH = (0, "datosAG")
+
+class LazyValue:
+    """A subtree left in the source file: its byte span, and its decoded value
+    once something needed it (see LazyDocument)."""
+    __slots__ = ("start", "end", "value")
+
+    def __init__(self, start: int, end: int, value=None):
+        self.start = start
+        self.end = end
+        self.value = value
+
+    def __reduce__(self):
+        # Much cheaper to pickle (binary cache) than the default slots state
+        return LazyValue, (self.start, self.end, self.value)
+
+class JsonRowStream:
+    """Incremental reader for JSON and JSONL closing files.
+
+    The file is read in chunks and the document tree is built as tokens
+    arrive; objects without nested containers (the cell rows) are decoded
+    in one json.loads call. Iterating yields (row, path, in_datosAG, keyed)
+    for every dict that may be a cell row, where path locates it in the
+    finished tree. After iteration, root holds the document (a list of
+    values for JSONL, like the old fallback) and select() keeps the rows
+    the old datosAG / collect_entries passes would have picked.
+
+    With lazy=True the tree is only a skeleton: rows, and containers that
+    hold no rows, are stored as LazyValue byte spans instead of parsed
+    values. Containers leading to rows, the top-level datosAG list and
+    formularioC[0].cod_fechas stay.
+    """
+
+    def __init__(self, path: str, chunk_size: int = 1 << 20, lazy: bool = False):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.lazy = lazy
+        self.total_bytes = os.path.getsize(path)
+        self.bytes_read = 0
+        self.root = None
+        self.docs: List = []
+
+    def __iter__(self):
+        lazy = self.lazy
+        # Frames are [container, is_dict, key, state, start offset, holds rows, kept]
+        stack: List[list] = []
+        buf = b""
+        base = 0  # file offset of buf[0]
+        # Top-level values after the first must start on a new line, as in JSONL
+        need_newline = False
+        newline = False
+        with open(self.path, "rb") as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                self.bytes_read += len(chunk)
+                final = not chunk
+                buf += chunk
+                pos = 0
+                n = len(buf)
+                while pos < n:
+                    m = _JSON_TOKEN.match(buf, pos)
+                    if m is None:
+                        if buf[pos:].strip():
+                            raise ValueError("JSON inválido")
+                        newline = newline or b"\n" in buf[pos:]
+                        pos = n
+                        break
+                    if not final and (m.end() == n or m.lastgroup == "open_str"):
+                        # The token may continue in the next chunk
+                        break
+                    if m.lastgroup == "open_str":
+                        raise ValueError("Cadena sin terminar en el JSON")
+                    kind = m.lastgroup
+                    text = m.group(kind)
+                    top = stack[-1] if stack else None
+                    is_key = False
+                    if kind == "punct" and text not in b"{[":
+                        state = top[3] if top is not None else None
+                        if text == b":":
+                            ok = state == _COLON
+                            state = _VALUE
+                        elif text == b",":
+                            ok = state == _NEXT
+                            state = _KEY if ok and top[1] else _VALUE
+                        else:
+                            ok = state in (_OPEN, _NEXT) and top[1] == (text == b"}")
+                        if not ok:
+                            raise ValueError("JSON inválido")
+                        top[3] = state
+                    elif top is None:
+                        if need_newline and not newline and b"\n" not in buf[pos:m.start(kind)]:
+                            raise ValueError("JSON inválido")
+                        if kind == "flat" and _FLAT_ONE.fullmatch(text) is None:
+                            raise ValueError("JSON inválido")
+                        need_newline = True
+                    elif top[1] and top[3] in (_OPEN, _KEY):
+                        if kind != "str":
+                            raise ValueError("JSON inválido")
+                        is_key = True
+                        top[3] = _COLON
+                    elif top[3] in (_OPEN, _VALUE):
+                        # A run of rows is several values only inside a list
+                        if kind == "flat" and top[1] and _FLAT_ONE.fullmatch(text) is None:
+                            raise ValueError("JSON inválido")
+                        top[3] = _NEXT
+                    else:
+                        raise ValueError("JSON inválido")
+                    newline = False
+                    pos = m.end()
+                    if kind == "flat":
+                        objs = json.loads(b"[" + text + b"]")
+                        if lazy:
+                            at = base + m.start(kind)
+                            spans = [LazyValue(at + o.start(), at + o.end()) for o in _FLAT_ONE.finditer(text)]
+                            keep = bool(stack) and stack[-1][6] and len(self._path(stack)) > len(_KEEP_PATH)
+                        if stack and not stack[-1][1]:
+                            top = stack[-1]
+                            parent = top[0]
+                            base_i = len(parent)
+                            parent.extend(objs if not lazy or keep else spans)
+                            prefix = self._path(stack)[:-1]
+                            for i, obj in enumerate(objs):
+                                hit = self._hit(obj, prefix + (base_i + i,))
+                                if hit:
+                                    top[5] = True
+                                    yield hit
+                        else:
+                            for i, obj in enumerate(objs):
+                                value = spans[i] if lazy and not keep else obj
+                                self._add_value(stack, value)
+                                hit = self._hit(obj, self._path(stack))
+                                if not stack:
+                                    # Top-level objects stay parsed unless they are rows (JSONL)
+                                    self.docs.append(value if hit else obj)
+                                elif hit:
+                                    stack[-1][5] = True
+                                if hit:
+                                    yield hit
+                    elif kind == "str" or kind == "scalar":
+                        val = json.loads(text)
+                        if is_key:
+                            top[2] = val
+                        elif top is not None:
+                            self._add_value(stack, val)
+                        else:
+                            self.docs.append(val)
+                    elif text == b"{" or text == b"[":
+                        container = {} if text == b"{" else []
+                        self._add_value(stack, container)
+                        kept = False
+                        if lazy:
+                            cpath = self._path(stack) if stack else (len(self.docs),)
+                            kept = cpath[:len(_KEEP_PATH)] == _KEEP_PATH[:len(cpath)] or cpath == _AG_PATH
+                        stack.append([container, text == b"{", None, _OPEN, base + m.start(kind), False, kept])
+                    elif text == b"}" or text == b"]":
+                        frame = stack.pop()
+                        hit = None
+                        if frame[1]:
+                            hit = self._hit(frame[0], self._path(stack))
+                            if hit:
+                                yield hit
+                        value = frame[0]
+                        if lazy and (hit or not (frame[5] or frame[6])) and stack:
+                            # Rows and row-free subtrees are read back from the file when needed
+                            value = LazyValue(frame[4], base + m.end())
+                            top = stack[-1]
+                            if top[1]:
+                                top[0][top[2]] = value
+                            else:
+                                top[0][-1] = value
+                        elif lazy and hit and not stack:
+                            value = LazyValue(frame[4], base + m.end())
+                        if stack and (hit or frame[5]):
+                            stack[-1][5] = True
+                        if not stack:
+                            self.docs.append(value)
+                buf = buf[pos:]
+                base += pos
+                if final:
+                    break
+        if stack:
+            raise ValueError("JSON incompleto")
+        self.root = self.docs[0] if len(self.docs) == 1 else list(self.docs)
+
+    def _add_value(self, stack: List[list], value):
+        # Top-level values are added to docs by the caller once complete
+        if not stack:
+            return
+        top = stack[-1]
+        if top[1]:
+            top[0][top[2]] = value
+        else:
+            top[0].append(value)
+
+    def _path(self, stack: List[list]) -> tuple:
+        # Leading doc index; stripped by select() when the file is one document
+        out = [len(self.docs)]
+        for container, is_dict, key, *_ in stack:
+            out.append(key if is_dict else len(container) - 1)
+        return tuple(out)
+
+    def _hit(self, obj: Dict, path: tuple):
+        in_ag = len(path) == 4 and path[1] == "datosAG" and isinstance(path[2], int) and isinstance(path[3], int)
+        keyed = "codigo" in obj and "posicion" in obj and "label" in obj
+        if in_ag or keyed:
+            return obj, path, in_ag, keyed
+        return None
+
+    def select(self, hits: List[tuple]) -> List[tuple]:
+        """Filter (payload, path, in_datosAG, keyed) hits to (payload, path)."""
+        single = len(self.docs) == 1
+        root = self.root
+        if single and isinstance(root, dict) and isinstance(root.get("datosAG"), list):
+            return [(x, path[1:]) for x, path, in_ag, _ in hits if in_ag]
+        keyed_paths = {path for _, path, _, keyed in hits if keyed}
+        out = []
+        for x, path, _, keyed in hits:
+            if not keyed:
+                continue
+            # collect_entries does not descend into a row once it matches
+            if any(path[:i] in keyed_paths for i in range(1, len(path))):
+                continue
+            out.append((x, path[1:] if single else path))
+        return out
+
+def item_from_row(d: Dict) -> Optional[CellItem]:
+    try:
+        return CellItem(
+            id_form=int(d.get("id_form", 0)),
+            label=sys.intern(str(d.get("label", ""))),
+            codigo=sys.intern(str(d.get("codigo", ""))),
+            tipo=int(d.get("tipo", 0)),
+            deci=int(d.get("deci", 0)),
+            posicion=parse_pos(str(d.get("posicion", "1:1"))),
+            valor=sys.intern(str(d.get("valor", ""))),
+        )
+    except Exception:
+        return None
+
+def load_closing_file(path: str, progress=None, cancelled=None, lazy: bool = False) -> Optional[Tuple[object, List[CellItem], List[tuple], bool]]:
+    """Parse a closing file into (root_data, items, paths, is_jsonl); None if cancelled.
+
+    paths[i] locates the row behind items[i] inside root_data. With lazy,
+    root_data is a skeleton to be read through a LazyDocument of path.
+    """
+    stream = JsonRowStream(path, lazy=lazy)
+    hits = []
+    for n, (row, row_path, in_ag, keyed) in enumerate(stream):
+        hits.append((item_from_row(row), row_path, in_ag, keyed))
+        if n % 2000 == 0:
+            if cancelled and cancelled():
+                return None
+            if progress:
+                progress(stream.bytes_read, stream.total_bytes)
+    items: List[CellItem] = []
+    paths: List[tuple] = []
+    for it, row_path in stream.select(hits):
+        if it is not None:
+            items.append(it)
+            paths.append(row_path)
+    return stream.root, items, paths, len(stream.docs) > 1
+
+class LazyDocument:
+    """The source file behind a lazy root_data skeleton, memory-mapped.
+
+    LazyValues are decoded on demand; read() keeps the result on the value
+    so edits to it are saved. save() copies every undecoded span verbatim
+    and serializes the rest the way write_closing_file does. The source
+    must not change on disk while it is open.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.stamp = None
+        self.buf = None
+        self.open()
+
+    def open(self):
+        st = os.stat(self.path)
+        self.stamp = (st.st_size, st.st_mtime_ns)
+        with open(self.path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.buf is not None:
+            self.buf.close()
+            self.buf = None
+
+    def raw(self, lv: LazyValue) -> bytes:
+        if self.buf is None:
+            raise ValueError("El documento original ya no está abierto")
+        return self.buf[lv.start:lv.end]
+
+    def peek(self, lv: LazyValue):
+        return lv.value if lv.value is not None else json.loads(self.raw(lv))
+
+    def read(self, lv: LazyValue):
+        if lv.value is None:
+            lv.value = json.loads(self.raw(lv))
+        return lv.value
+
+    def changed(self) -> bool:
+        st = os.stat(self.path)
+        return (st.st_size, st.st_mtime_ns) != self.stamp
+
+    def detach(self, root):
+        """Decode every span still in the file and close it, before the file is overwritten."""
+        def walk(v):
+            if isinstance(v, LazyValue):
+                self.read(v)
+            elif isinstance(v, dict):
+                for x in v.values():
+                    walk(x)
+            elif isinstance(v, list):
+                for x in v:
+                    walk(x)
+        walk(root)
+        self.close()
+
+    def save(self, path: str, root, jsonl: bool = False):
+        if self.buf is not None and self.changed():
+            raise ValueError("El archivo original cambió en disco desde que se abrió")
+        same = self.buf is not None and os.path.exists(path) and os.path.samefile(path, self.path)
+        # (value, start, end) of every span in the new file, to re-point them when it replaces the source
+        spans: List[tuple] = []
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            out = _SpanWriter(f, self, spans)
+            if jsonl:
+                for doc in root:
+                    out.value(doc, None, 0)
+                    out.write(b"\n")
+            else:
+                out.value(root, 2, 0)
+        if same:
+            # Windows cannot replace a mapped file
+            self.close()
+            try:
+                os.replace(tmp, path)
+            finally:
+                self.open()
+            for lv, start, end in spans:
+                lv.start = start
+                lv.end = end
+                lv.value = None
+        else:
+            os.replace(tmp, path)
+
+class _SpanWriter:
+    # json.dump layout (indent=2, ensure_ascii=False, or one line per JSONL doc)
+    # with undecoded LazyValues copied from the source bytes
+
+    def __init__(self, f, doc: LazyDocument, spans: List[tuple]):
+        self.f = f
+        self.doc = doc
+        self.spans = spans
+        self.pos = 0
+
+    def write(self, b: bytes):
+        self.f.write(b)
+        self.pos += len(b)
+
+    def value(self, v, indent: Optional[int], level: int):
+        if isinstance(v, LazyValue):
+            start = self.pos
+            if v.value is None:
+                self.write(self.doc.raw(v))
+            else:
+                self.value(v.value, indent, level)
+            self.spans.append((v, start, self.pos))
+        elif isinstance(v, (dict, list)) and v:
+            is_dict = isinstance(v, dict)
+            self.write(b"{" if is_dict else b"[")
+            if indent is None:
+                sep, pad, end = b", ", b"", b""
+            else:
+                pad = b"\n" + b" " * (indent * (level + 1))
+                sep, end = b"," + pad, b"\n" + b" " * (indent * level)
+            self.write(pad)
+            for i, x in enumerate(v.items() if is_dict else v):
+                if i:
+                    self.write(sep)
+                if is_dict:
+                    self.write(json.dumps(x[0], ensure_ascii=False).encode("utf-8") + b": ")
+                    x = x[1]
+                self.value(x, indent, level + 1)
+            self.write(end + (b"}" if is_dict else b"]"))
+        else:
+            self.write(json.dumps(v, ensure_ascii=False).encode("utf-8"))
+
+CACHE_SUFFIX = ".cmcache"
+# Small files parse faster than the cache is worth
+CACHE_MIN_BYTES = 4 * 1024 * 1024
+# Bump the version whenever the payload layout or CellItem fields change
+_CACHE_MAGIC = b"CMCACHE3"
+# magic, source size, source mtime_ns, blake2b digest of the source
+_CACHE_HEADER = struct.Struct("<8sQq32s")
+
+def cache_dir() -> str:
+    # CIERRESMAKER_CACHE_DIR moves the caches and journals elsewhere, e.g. for the benchmarks
+    if os.environ.get("CIERRESMAKER_CACHE_DIR"):
+        return os.environ["CIERRESMAKER_CACHE_DIR"]
+    base = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "cierresmaker")
+
+def cache_path(path: str) -> str:
+    # Kept in the user's own cache dir, never beside the source: the payload is a pickle
+    key = hashlib.blake2b(os.path.abspath(path).encode("utf-8"), digest_size=16).hexdigest()
+    return os.path.join(cache_dir(), key + CACHE_SUFFIX)
+
+def file_digest(path: str) -> bytes:
+    h = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.digest()
+
+def read_cache(path: str, lazy: bool = False) -> Optional[Tuple[object, List[CellItem], List[tuple], bool]]:
+    """The cached load_closing_file result for path, or None if missing or stale.
+
+    The cache is trusted when the source's size and mtime still match;
+    with only the mtime changed (copied or touched) the content hash decides.
+    """
+    try:
+        st = os.stat(path)
+        with open(cache_path(path), "rb") as f:
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                buf = f.read()
+            try:
+                if len(buf) < _CACHE_HEADER.size:
+                    return None
+                magic, size, mtime_ns, digest = _CACHE_HEADER.unpack_from(buf)
+                if magic != _CACHE_MAGIC or size != st.st_size:
+                    return None
+                if mtime_ns != st.st_mtime_ns and file_digest(path) != digest:
+                    return None
+                view = memoryview(buf)
+                try:
+                    root, cols, paths, jsonl, cached_lazy = pickle.loads(view[_CACHE_HEADER.size:])
+                finally:
+                    view.release()
+            finally:
+                if isinstance(buf, mmap.mmap):
+                    buf.close()
+    except Exception:
+        # Unreadable, truncated or from another version: parse the source instead
+        return None
+    if cached_lazy != lazy:
+        return None
+    return root, items_from_columns(cols), paths, jsonl
+
+def items_from_columns(cols) -> List[CellItem]:
+    """Rebuild items stored one column per field, sharing positions and strings with the other documents."""
+    cols = list(cols)
+    k = CELL_FIELDS.index("posicion")
+    cols[k] = [_POS_CACHE.setdefault(p, p) for p in cols[k]]
+    for f in ("label", "codigo", "valor"):
+        k = CELL_FIELDS.index(f)
+        cols[k] = [sys.intern(v) for v in cols[k]]
+    return [CellItem(*row) for row in zip(*cols)]
+
+def write_cache(path: str, root, items: List[CellItem], paths: List[tuple], jsonl: bool, lazy: bool = False) -> bool:
+    """Cache a freshly parsed file; False if it is too small or could not be written."""
+    try:
+        st = os.stat(path)
+        if st.st_size < CACHE_MIN_BYTES:
+            return False
+        header = _CACHE_HEADER.pack(_CACHE_MAGIC, st.st_size, st.st_mtime_ns, file_digest(path))
+        # Column per field: far cheaper to pickle than one object per item
+        cols = tuple([getattr(d, f) for d in items] for f in CELL_FIELDS)
+        payload = pickle.dumps((root, cols, paths, jsonl, lazy), protocol=pickle.HIGHEST_PROTOCOL)
+        os.makedirs(cache_dir(), exist_ok=True)
+        tmp = cache_path(path) + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(header)
+            f.write(payload)
+        os.replace(tmp, cache_path(path))
+        return True
+    except OSError:
+        return False
+
+def pack_state(state) -> bytes:
+    """Compress a picklable editor state; shared items stay shared after unpack_state()."""
+    return zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL), 1)
+
+def unpack_state(blob: bytes):
+    return pickle.loads(zlib.decompress(blob))
+
+def open_closing_file(path: str, progress=None, cancelled=None, lazy: bool = False) -> Optional[Tuple[object, List[CellItem], List[tuple], bool]]:
+    """load_closing_file through the binary cache, refreshing it after a parse."""
+    cached = read_cache(path, lazy)
+    if cached is not None:
+        return cached
+    result = load_closing_file(path, progress, cancelled, lazy)
+    if result is not None:
+        write_cache(path, *result, lazy=lazy)
+    return result
+
+class DuplicateIndex:
+    """Normalized code -> items carrying it, kept current as cells are edited.
+
+    add/remove/update return the items whose duplicate status flipped, so
+    the caller only repaints those cells.
+    """
+
+    def __init__(self):
+        self.by_code: Dict[str, Dict[int, CellItem]] = {}
+        self.code_of: Dict[int, str] = {}
+
+    def clear(self):
+        self.by_code = {}
+        self.code_of = {}
+
+    def rebuild(self, items: List[CellItem]):
+        self.clear()
+        for d in items:
+            self.add(d)
+
+    def add(self, d: CellItem) -> List[CellItem]:
+        code = norm_code(d.codigo)
+        if not code:
+            return []
+        bucket = self.by_code.setdefault(code, {})
+        bucket[id(d)] = d
+        self.code_of[id(d)] = code
+        if len(bucket) == 2:
+            return list(bucket.values())
+        if len(bucket) > 2:
+            return [d]
+        return []
+
+    def remove(self, d: CellItem) -> List[CellItem]:
+        code = self.code_of.pop(id(d), None)
+        if code is None:
+            return []
+        bucket = self.by_code[code]
+        bucket.pop(id(d), None)
+        if not bucket:
+            del self.by_code[code]
+        elif len(bucket) == 1:
+            return list(bucket.values())
+        return []
+
+    def update(self, d: CellItem) -> List[CellItem]:
+        if self.code_of.get(id(d), "") == norm_code(d.codigo):
+            return []
+        return self.remove(d) + self.add(d)
+
+    def is_duplicate(self, d: CellItem) -> bool:
+        code = self.code_of.get(id(d))
+        return code is not None and len(self.by_code[code]) > 1
+
+class SourceIndex:
+    """Links loaded items to their rows in root_data so a save only patches what changed.
+
+    Edits mark items dirty. patch() rewrites those rows, appends rows for new
+    items next to loaded rows of the same period and drops rows of removed
+    items. Items are held by the index, so their ids stay unique. Rows of a
+    lazy root_data are LazyValues, decoded through doc only when rewritten.
+    """
+
+    def __init__(self):
+        # id(item) -> (item, parent container, key in parent, row)
+        self.rows: Dict[int, tuple] = {}
+        self.homes: Dict[str, list] = {}
+        # id(item) -> (item, period, live)
+        self.dirty: Dict[int, tuple] = {}
+        # Set by row/column shifts, which move too many items to mark one by one
+        self.positions_stale = False
+        self.doc: Optional[LazyDocument] = None
+
+    def clear(self):
+        self.doc = None
+        self.rows = {}
+        self.homes = {}
+        self.dirty = {}
+        self.positions_stale = False
+
+    def touch_positions(self):
+        self.positions_stale = True
+
+    def __getstate__(self):
+        # Keys are ids, which do not survive pickling; the mapped document is reattached by the owner
+        return {"rows": list(self.rows.values()), "homes": self.homes,
+                "dirty": list(self.dirty.values()), "positions_stale": self.positions_stale}
+
+    def __setstate__(self, state):
+        self.rows = {id(src[0]): src for src in state["rows"]}
+        self.homes = state["homes"]
+        self.dirty = {id(src[0]): src for src in state["dirty"]}
+        self.positions_stale = state["positions_stale"]
+        self.doc = None
+
+    def build(self, root, items: List[CellItem], paths: List[tuple], periods: List[str], doc: Optional[LazyDocument] = None):
+        self.clear()
+        self.doc = doc
+        for d, path, period in zip(items, paths, periods):
+            if not path:
+                # The whole document is the row: no parent, rewritten as one span
+                self.rows[id(d)] = (d, None, None, root)
+                continue
+            parent = root
+            for k in path[:-1]:
+                parent = parent[k]
+            key = path[-1]
+            self.rows[id(d)] = (d, parent, key, parent[key])
+            if isinstance(parent, list):
+                self.homes.setdefault(period, parent)
+
+    def can_patch(self) -> bool:
+        """Whether patch() can place every pending change in root_data.
+
+        New items need a list of rows to join and a row that is the whole
+        document cannot be dropped; otherwise the save has to be flat.
+        """
+        if self.homes:
+            return True
+        return bool(self.rows) and all(live and key_id in self.rows for key_id, (_, _, live) in self.dirty.items())
+
+    def mark(self, d: CellItem, period: Optional[str] = None, live: bool = True):
+        prev = self.dirty.get(id(d))
+        if period is None and prev is not None:
+            period = prev[1]
+        self.dirty[id(d)] = (d, period, live)
+
+    def ordered_items(self, root) -> List[CellItem]:
+        """Items in the order their rows appear in root_data, i.e. the order a reload yields."""
+        by_row = {id(src[3]): src[0] for src in self.rows.values()}
+        out: List[CellItem] = []
+        def walk(v):
+            d = by_row.get(id(v))
+            if d is not None:
+                out.append(d)
+            elif isinstance(v, dict):
+                for x in v.values():
+                    walk(x)
+            elif isinstance(v, list):
+                for x in v:
+                    walk(x)
+        walk(root)
+        return out
+
+    def row_dict(self, row) -> Dict:
+        return self.doc.read(row) if isinstance(row, LazyValue) else row
+
+    def patch(self) -> int:
+        """Apply dirty items to root_data; returns how many were written."""
+        if self.positions_stale:
+            for key_id, (d, _, _, row) in self.rows.items():
+                if key_id not in self.dirty:
+                    pos = fmt_pos(*d.posicion)
+                    # Rows still in the file are only decoded if they really moved
+                    if isinstance(row, LazyValue) and self.doc.peek(row).get("posicion") == pos:
+                        continue
+                    self.row_dict(row)["posicion"] = pos
+            self.positions_stale = False
+        drops: Dict[int, tuple] = {}
+        for key_id, (d, period, live) in self.dirty.items():
+            src = self.rows.get(key_id)
+            if live:
+                if src is not None:
+                    self.row_dict(src[3]).update(d.to_json())
+                    continue
+                home = self.homes.get(period) or next(iter(self.homes.values()), None)
+                if home is None:
+                    continue
+                row = d.to_json()
+                home.append(row)
+                self.rows[key_id] = (d, home, None, row)
+            elif src is not None:
+                _, parent, key, row = self.rows.pop(key_id)
+                if isinstance(parent, list):
+                    drops.setdefault(id(parent), (parent, set()))[1].add(id(row))
+                elif parent is not None:
+                    parent.pop(key, None)
+        # One pass per touched list, so indices of the remaining rows never matter
+        for parent, row_ids in drops.values():
+            parent[:] = [r for r in parent if id(r) not in row_ids]
+        n = len(self.dirty)
+        self.dirty = {}
+        return n
+
+PERIODS = ("dia", "semana", "mes", "anio")
+_CODE_PERIODS = {"CD": "dia", "CS": "semana", "CM": "mes", "CA": "anio"}
+_LABEL_PERIODS = (("DIA", "dia"), ("SEMANA", "semana"), ("MES", "mes"), ("AÑO", "anio"), ("ANIO", "anio"))
+
+# Label and code lookups are memoized process-wide, so every open document shares them
+_TEXT_CACHE_SIZE = 1 << 18
+
+@functools.lru_cache(maxsize=_TEXT_CACHE_SIZE)
+def code_period(code: str) -> Optional[str]:
+    return _CODE_PERIODS.get(code.strip().upper()[:2])
+
+@functools.lru_cache(maxsize=_TEXT_CACHE_SIZE)
+def label_period(lbl: str) -> Optional[str]:
+    lbl = lbl.upper()
+    for k, p in _LABEL_PERIODS:
+        if k in lbl:
+            return p
+    return None
+
+def classify_period(d: CellItem, global_ids: Dict[str, Optional[int]]) -> Optional[str]:
+    p = code_period(d.codigo)
+    if p:
+        return p
+    for k in PERIODS:
+        val = global_ids.get(k)
+        if val is not None and d.id_form == val:
+            return k
+    return label_period(d.label)
+
+class PeriodIndex:
+    """Cached period of every live item, plus the items of each period in a bucket.
+
+    An item is classified again only by update(), after its codigo, label or
+    id_form changed, or by reclassify() after the global ids changed, which
+    only revisits items whose code has no period prefix. Bucket order is
+    insertion order.
+    """
+
+    def __init__(self, classify):
+        self.classify = classify
+        self.period_of: Dict[int, Optional[str]] = {}
+        self.buckets: Dict[str, Dict[int, CellItem]] = {p: {} for p in PERIODS}
+        # Items whose period can follow the global ids
+        self.loose: Dict[int, CellItem] = {}
+
+    def clear(self):
+        self.period_of = {}
+        self.buckets = {p: {} for p in PERIODS}
+        self.loose = {}
+
+    def rebuild(self, items: List[CellItem]):
+        self.clear()
+        for d in items:
+            self.add(d)
+
+    def get(self, d: CellItem) -> Optional[str]:
+        key = id(d)
+        if key in self.period_of:
+            return self.period_of[key]
+        return self.classify(d)
+
+    def bucket_of(self, d: CellItem) -> str:
+        return self.get(d) or "dia"
+
+    def _settle(self, key: int, d: CellItem):
+        if code_period(d.codigo):
+            self.loose.pop(key, None)
+        else:
+            self.loose[key] = d
+
+    def add(self, d: CellItem):
+        key = id(d)
+        p = self.classify(d)
+        self.period_of[key] = p
+        self.buckets[p or "dia"][key] = d
+        self._settle(key, d)
+
+    def remove(self, d: CellItem):
+        key = id(d)
+        if key not in self.period_of:
+            return
+        p = self.period_of.pop(key)
+        del self.buckets[p or "dia"][key]
+        self.loose.pop(key, None)
+
+    def update(self, d: CellItem) -> bool:
+        """Reclassify d; True if it moved to another bucket."""
+        key = id(d)
+        if key not in self.period_of:
+            self.add(d)
+            return True
+        old = self.period_of[key] or "dia"
+        p = self.classify(d)
+        self.period_of[key] = p
+        self._settle(key, d)
+        if old == (p or "dia"):
+            return False
+        del self.buckets[old][key]
+        self.buckets[p or "dia"][key] = d
+        return True
+
+    def reclassify(self) -> List[CellItem]:
+        """Follow a global ids change; returns the items that changed bucket."""
+        return [d for d in list(self.loose.values()) if self.update(d)]
+
+_PERIOD_SUFFIXES = (" DIA", " SEMANA", " MES", " AÑO", " ANIO")
+
+@functools.lru_cache(maxsize=_TEXT_CACHE_SIZE)
+def normalize_label(lbl: str) -> str:
+    u = lbl.upper().strip()
+    for k in _PERIOD_SUFFIXES:
+        if u.endswith(k):
+            u = u[: -len(k)]
+            break
+    return u
+
+class GroupIndex:
+    """Base label -> period -> items, kept current as items change, plus grid extents.
+
+    Extents are running maxima over per-row and per-column item counts, so
+    they only rescan the distinct rows or columns when the last item of the
+    outermost one leaves.
+    """
+
+    def __init__(self, periods: PeriodIndex):
+        self.periods = periods
+        self.groups: Dict[str, Dict[str, List[CellItem]]] = {}
+        # id(item) -> (base, period) it is filed under
+        self.key_of: Dict[int, Tuple[str, str]] = {}
+        self.row_counts: Dict[int, int] = {}
+        self.col_counts: Dict[int, int] = {}
+        self.max_r = -1
+        self.max_c = -1
+
+    def clear(self):
+        self.groups = {}
+        self.key_of = {}
+        self.row_counts = {}
+        self.col_counts = {}
+        self.max_r = -1
+        self.max_c = -1
+
+    def rebuild(self, items: List[CellItem]):
+        self.clear()
+        groups = self.groups
+        key_of = self.key_of
+        bucket_of = self.periods.bucket_of
+        rows = self.row_counts
+        cols = self.col_counts
+        for d in items:
+            key = (normalize_label(d.label), bucket_of(d))
+            by_period = groups.get(key[0])
+            if by_period is None:
+                by_period = groups[key[0]] = {}
+            members = by_period.get(key[1])
+            if members is None:
+                by_period[key[1]] = [d]
+            else:
+                members.append(d)
+            key_of[id(d)] = key
+            r, c = d.posicion
+            rows[r] = rows.get(r, 0) + 1
+            cols[c] = cols.get(c, 0) + 1
+        self.max_r = max(rows, default=-1)
+        self.max_c = max(cols, default=-1)
+
+    def get(self, base: str) -> Dict[str, List[CellItem]]:
+        return self.groups.get(base, {})
+
+    def group_of(self, d: CellItem) -> Dict[str, List[CellItem]]:
+        return self.get(normalize_label(d.label))
+
+    def add(self, d: CellItem):
+        key = (normalize_label(d.label), self.periods.bucket_of(d))
+        self.groups.setdefault(key[0], {}).setdefault(key[1], []).append(d)
+        self.key_of[id(d)] = key
+        self._count(d.posicion, 1)
+
+    def remove(self, d: CellItem):
+        key = self.key_of.pop(id(d), None)
+        if key is None:
+            return
+        self._unfile(d, key)
+        self._count(d.posicion, -1)
+
+    def update(self, d: CellItem):
+        """Refile d after its label or period changed."""
+        key = self.key_of.get(id(d))
+        new = (normalize_label(d.label), self.periods.bucket_of(d))
+        if key is None or key == new:
+            return
+        self._unfile(d, key)
+        self.groups.setdefault(new[0], {}).setdefault(new[1], []).append(d)
+        self.key_of[id(d)] = new
+
+    def move(self, d: CellItem, old: Tuple[int, int], new: Tuple[int, int]):
+        if id(d) in self.key_of:
+            self._count(old, -1)
+            self._count(new, 1)
+
+    def shift(self, axis: int, start: int, delta: int):
+        # Same convention as GridEditor._shift_positions; O(distinct rows or columns)
+        counts = self.row_counts if axis == 0 else self.col_counts
+        lo = start if delta > 0 else start - delta
+        shifted: Dict[int, int] = {}
+        for k, n in counts.items():
+            k2 = k + delta if k >= lo else k
+            shifted[k2] = shifted.get(k2, 0) + n
+        if axis == 0:
+            self.row_counts = shifted
+            self.max_r = max(shifted, default=-1)
+        else:
+            self.col_counts = shifted
+            self.max_c = max(shifted, default=-1)
+
+    def _unfile(self, d: CellItem, key: Tuple[str, str]):
+        base, period = key
+        by_period = self.groups[base]
+        members = by_period[period]
+        for i, x in enumerate(members):
+            if x is d:
+                del members[i]
+                break
+        if not members:
+            del by_period[period]
+            if not by_period:
+                del self.groups[base]
+
+    def _count(self, pos: Tuple[int, int], delta: int):
+        r, c = pos
+        self.max_r = self._bump(self.row_counts, r, delta, self.max_r)
+        self.max_c = self._bump(self.col_counts, c, delta, self.max_c)
+
+    @staticmethod
+    def _bump(counts: Dict[int, int], k: int, delta: int, top: int) -> int:
+        n = counts.get(k, 0) + delta
+        if n > 0:
+            counts[k] = n
+            return max(top, k)
+        counts.pop(k, None)
+        if k == top:
+            return max(counts, default=-1)
+        return top
+
+class SearchIndex:
+    """Lowercased "codigo | label | valor" text of every item for the sidebar search.
+
+    Period membership and order come from a PeriodIndex. Each period is
+    searched as one joined string with str.find, rejoined lazily after
+    edits, and a query that extends the previous one only rechecks the
+    previous hits.
+    """
+
+    SEP = "\x00"
+
+    def __init__(self, periods: PeriodIndex):
+        self.periods = periods
+        self.texts: Dict[int, str] = {}
+        # period -> (joined text, entry start offsets, entries)
+        self.corpus: Dict[str, tuple] = {}
+        self.generation = 0
+        self.last: Optional[tuple] = None
+
+    def clear(self):
+        self.texts = {}
+        self.invalidate()
+
+    def rebuild(self, items: List[CellItem]):
+        self.clear()
+        for d in items:
+            self.texts[id(d)] = f"{d.codigo} | {d.label} | {d.valor}".lower()
+
+    def invalidate(self, *periods: str):
+        self.generation += 1
+        if not periods:
+            self.corpus = {}
+        for p in periods:
+            self.corpus.pop(p, None)
+
+    def update(self, d: CellItem, old_period: Optional[str] = None):
+        # old_period is d's bucket before the edit, when it may have moved
+        self.texts[id(d)] = f"{d.codigo} | {d.label} | {d.valor}".lower()
+        self.invalidate(self.periods.bucket_of(d), old_period or self.periods.bucket_of(d))
+
+    def remove(self, d: CellItem):
+        if self.texts.pop(id(d), None) is not None:
+            self.invalidate(self.periods.bucket_of(d))
+
+    def matches(self, d: CellItem, period: str, text: str) -> bool:
+        t = self.texts.get(id(d))
+        return t is not None and text in t and self.periods.bucket_of(d) == period
+
+    def _corpus(self, period: str) -> tuple:
+        corpus = self.corpus.get(period)
+        if corpus is None:
+            texts = self.texts
+            entries = [(d, texts[key]) for key, d in self.periods.buckets[period].items()]
+            starts = []
+            n = 0
+            for _, text in entries:
+                starts.append(n)
+                n += len(text) + 1
+            corpus = (self.SEP.join(text for _, text in entries), starts, entries)
+            self.corpus[period] = corpus
+        return corpus
+
+    def search(self, period: str, text: str) -> List[CellItem]:
+        """Items of period whose text contains text (already lowercased)."""
+        last = self.last
+        if last and last[0] == period and last[2] == self.generation and last[1] in text:
+            hits = [e for e in last[3] if text in e[1]]
+        elif not text:
+            hits = self._corpus(period)[2]
+        else:
+            joined, starts, entries = self._corpus(period)
+            hits = []
+            i = joined.find(text)
+            while i >= 0:
+                k = bisect.bisect_right(starts, i) - 1
+                hits.append(entries[k])
+                # One hit per entry: resume at the next one
+                if k + 1 >= len(starts):
+                    break
+                i = joined.find(text, starts[k + 1])
+        self.last = (period, text, self.generation, hits)
+        return [d for d, _ in hits]
+
+DIFF_FIELDS = ("label", "codigo", "id_form", "tipo", "deci", "valor")
+
+@dataclass
+class DiffEntry:
+    kind: str  # "added", "removed", "moved" (maybe with fields too) or "changed"
+    period: str
+    old: Optional[CellItem]
+    new: Optional[CellItem]
+    fields: Tuple[str, ...] = ()
+
+def _match_items(old: List[Tuple[CellItem, str]], new: List[Tuple[CellItem, str]], key):
+    # Pairs items of one period with equal key(item), same position first;
+    # returns the pairs and what is left unmatched on each side
+    buckets: Dict[tuple, List[CellItem]] = {}
+    for d, p in old:
+        k = key(d)
+        if k:
+            b = buckets.get((p, k))
+            if b is None:
+                buckets[(p, k)] = [d]
+            else:
+                b.append(d)
+    # Only keys shared by several items need their positions told apart
+    at: Dict[tuple, List[CellItem]] = {}
+    for bk, b in buckets.items():
+        if len(b) > 1:
+            for d in b:
+                at.setdefault((bk, d.posicion), []).append(d)
+    taken = set()
+    pairs, deferred, new_rest = [], [], []
+    for d, p in new:
+        k = key(d)
+        b = buckets.get((p, k)) if k else None
+        if b is None:
+            new_rest.append((d, p))
+            continue
+        if len(b) == 1:
+            o = b[0] if b[0].posicion == d.posicion and id(b[0]) not in taken else None
+        else:
+            o = next((x for x in at.get(((p, k), d.posicion), ()) if id(x) not in taken), None)
+        if o is None:
+            deferred.append((d, p, b))
+        else:
+            taken.add(id(o))
+            pairs.append((o, d, p))
+    for d, p, b in deferred:
+        o = next((x for x in b if id(x) not in taken), None)
+        if o is None:
+            new_rest.append((d, p))
+        else:
+            taken.add(id(o))
+            pairs.append((o, d, p))
+    return pairs, [(d, p) for d, p in old if id(d) not in taken], new_rest
+
+def diff_items(old: List[Tuple[CellItem, str]], new: List[Tuple[CellItem, str]]) -> List[DiffEntry]:
+    """What changed from old to new, both as (item, period) pairs; unchanged items are left out.
+
+    Items are matched within a period by codigo and then by normalized
+    label, through hash indexes, so the cost is linear in the item count.
+    """
+    # Same normalization as norm_code, without a call per item
+    pairs, old_rest, new_rest = _match_items(old, new, lambda d: d.codigo.strip().upper())
+    by_label, old_rest, new_rest = _match_items(old_rest, new_rest, lambda d: normalize_label(d.label))
+    values = operator.attrgetter(*DIFF_FIELDS)
+    entries = []
+    for o, n, p in pairs + by_label:
+        moved = o.posicion != n.posicion
+        if not moved and values(o) == values(n):
+            continue
+        fields = tuple(f for f in DIFF_FIELDS if getattr(o, f) != getattr(n, f))
+        entries.append(DiffEntry("moved" if moved else "changed", p, o, n, fields))
+    entries.extend(DiffEntry("removed", p, d, None) for d, p in old_rest)
+    entries.extend(DiffEntry("added", p, None, d) for d, p in new_rest)
+    return entries
+
+class ClosingDiff:
+    """diff_items entries indexed for painting over the newer document.
+
+    Entries of current items are found by item, so they follow later edits;
+    removed items stay at the (posicion, period) they had.
+    """
+
+    def __init__(self, source: str, entries: List[DiffEntry]):
+        self.source = source
+        self.entries = entries
+        self.index()
+
+    def index(self):
+        self.by_item = {id(e.new): e for e in self.entries if e.new is not None}
+        self.removed = {(e.old.posicion, e.period): e for e in self.entries if e.kind == "removed"}
+
+    def __getstate__(self):
+        return {"source": self.source, "entries": self.entries}
+
+    def __setstate__(self, state):
+        self.source = state["source"]
+        self.entries = state["entries"]
+        self.index()
+
+    def counts(self, period: Optional[str] = None) -> Dict[str, int]:
+        return dict(Counter(e.kind for e in self.entries if period is None or e.period == period))
+
+HISTORY_MAX_BYTES = 64 * 1024 * 1024
+
+def op_size(op: tuple) -> int:
+    # Rough footprint of one recorded op, used to bound the history by memory
+    kind = op[0]
+    if kind in ("add", "remove"):
+        d = op[1]
+        return 120 + sum(sys.getsizeof(getattr(d, f)) for f in CELL_FIELDS)
+    if kind in ("clear", "remap"):
+        return 120 + 160 * len(op[1])
+    return 120 + sum(sys.getsizeof(v) for v in op[1:])
+
+class EditCommand:
+    """The ops recorded between one save_state() and the next.
+
+    Ops are tuples describing a single change:
+      ("add", item, period, displaced_item) / ("remove", item, period)
+      ("set", item, period, field, old, new)
+      ("move", item, period, old_pos, new_pos, displaced_item)
+      ("shift", axis, start, delta)  delta < 0 closes [start, start - delta)
+      ("ids", old_global_ids, new_global_ids)
+      ("remap", [(item, period, old_id_form, new_id_form)], old_global_ids, new_global_ids)
+      ("clear", old_items, old_pos_to_item)
+    """
+
+    def __init__(self):
+        self.ops: List[tuple] = []
+        self.size = 0
+
+    def record(self, op: tuple):
+        self.ops.append(op)
+        self.size += op_size(op)
+
+class EditHistory:
+    """Undo/redo stacks of EditCommands, trimmed by estimated memory size."""
+
+    def __init__(self, max_bytes: int = HISTORY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.undo_stack: List[EditCommand] = []
+        self.redo_stack: List[EditCommand] = []
+        self.current: Optional[EditCommand] = None
+        self.undo_bytes = 0
+        # Every recorded op, undo and redo is mirrored here when set
+        self.journal: Optional["EditJournal"] = None
+
+    def clear(self):
+        self.undo_stack = []
+        self.redo_stack = []
+        self.current = None
+        self.undo_bytes = 0
+
+    def begin(self):
+        self.close()
+        self.current = EditCommand()
+        self.undo_stack.append(self.current)
+        self.redo_stack.clear()
+        if self.journal:
+            self.journal.begin()
+
+    def push(self, cmd: EditCommand):
+        """Add an already applied command, as if it had been recorded."""
+        self.begin()
+        self.current.ops = cmd.ops
+        self.current.size = cmd.size
+        self.close()
+
+    def close(self):
+        # Account for the open command and drop it if nothing was recorded
+        cmd = self.current
+        self.current = None
+        if cmd is None:
+            return
+        if not cmd.ops:
+            if self.undo_stack and self.undo_stack[-1] is cmd:
+                self.undo_stack.pop()
+            return
+        self.undo_bytes += cmd.size
+        while self.undo_bytes > self.max_bytes and len(self.undo_stack) > 1:
+            self.undo_bytes -= self.undo_stack.pop(0).size
+
+    def record(self, op: tuple):
+        if self.current is not None:
+            self.current.record(op)
+            if self.journal:
+                self.journal.op(op)
+
+    def pop_undo(self) -> Optional[EditCommand]:
+        self.close()
+        if not self.undo_stack:
+            return None
+        cmd = self.undo_stack.pop()
+        self.undo_bytes -= cmd.size
+        self.redo_stack.append(cmd)
+        if self.journal:
+            self.journal.mark("undo")
+        return cmd
+
+    def pop_redo(self) -> Optional[EditCommand]:
+        self.close()
+        if not self.redo_stack:
+            return None
+        cmd = self.redo_stack.pop()
+        self.undo_stack.append(cmd)
+        self.undo_bytes += cmd.size
+        if self.journal:
+            self.journal.mark("redo")
+        return cmd
+
+JOURNAL_VERSION = 1
+# Buffered lines that force a write without waiting for the caller's flush
+JOURNAL_MAX_PENDING = 1000
+
+def journal_dir() -> str:
+    return os.path.join(cache_dir(), "journal")
+
+def journal_path(source: str) -> str:
+    key = hashlib.blake2b(os.path.abspath(source).encode("utf-8"), digest_size=16).hexdigest()
+    return os.path.join(journal_dir(), key + ".journal")
+
+def items_fingerprint(items: List[CellItem]) -> str:
+    # Load order plus code and position: enough to tell the journal's numbering still holds
+    h = hashlib.blake2b(digest_size=16)
+    for d in items:
+        h.update(f"{d.codigo}\x00{d.posicion[0]}:{d.posicion[1]}\n".encode("utf-8"))
+    return h.hexdigest()
+
+def read_journal(path: str) -> Tuple[Optional[Dict], List[list]]:
+    """(header, entries) of a journal; entries stop at a torn last line."""
+    header = None
+    entries: List[list] = []
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if header is None:
+                    if entry[:2] != ["journal", JOURNAL_VERSION]:
+                        return None, []
+                    header = entry[2]
+                else:
+                    entries.append(entry)
+    except OSError:
+        return None, []
+    return header, entries
+
+class EditJournal:
+    """Append-only log of the edits made since a file was loaded or saved.
+
+    One JSON array per line: a header describing the base file, ["begin"]
+    before the first op of each command, the ops EditHistory records,
+    ["undo"] / ["redo"], and ["config", ids] for id changes made outside the
+    history. Items are written as their number: load order for the base
+    file, then creation order, with new items carrying their data. Replaying
+    the entries over the reloaded base file restores the session.
+
+    Lines are buffered; flush() writes them, and on_pending is called when
+    the buffer stops being empty so the caller can schedule it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.f = None
+        self.buffer: List[str] = []
+        self.items: List[CellItem] = []
+        self.number: Dict[int, int] = {}
+        self.pending_begin = False
+        self.on_pending = None
+
+    def register(self, items: List[CellItem]):
+        # The journal holds the items, so their ids are never reused
+        self.items = list(items)
+        self.number = {id(d): i for i, d in enumerate(self.items)}
+
+    def start(self, source: str, ids: Dict[str, Optional[int]], filtered: bool, items: List[CellItem]):
+        """Begin a new journal over source, whose reload yields items in this order."""
+        self.close()
+        self.register(items)
+        header = {
+            "source": os.path.abspath(source),
+            "ids": ids,
+            "filtered": filtered,
+            "count": len(items),
+            "fingerprint": items_fingerprint(items),
+        }
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.f = open(self.path, "w", encoding="utf-8")
+            self.buffer = [json.dumps(["journal", JOURNAL_VERSION, header], ensure_ascii=False)]
+            self.flush()
+        except OSError:
+            self.f = None
+
+    def resume(self):
+        """Keep appending to the journal that was just replayed."""
+        try:
+            self.f = open(self.path, "a", encoding="utf-8")
+        except OSError:
+            self.f = None
+
+    def close(self):
+        self.suspend()
+        self.buffer = []
+        self.pending_begin = False
+
+    def suspend(self):
+        """Write what is pending and let go of the file; resume() reopens it."""
+        self.flush()
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def __getstate__(self):
+        # Only a suspended journal is packed; numbers are ids and are rebuilt
+        return {"path": self.path, "items": self.items, "pending_begin": self.pending_begin}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.f = None
+        self.buffer = []
+        self.on_pending = None
+        self.register(state["items"])
+        self.pending_begin = state["pending_begin"]
+
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def append(self, entry: list):
+        if self.f is None:
+            return
+        self.buffer.append(json.dumps(entry, ensure_ascii=False))
+        if len(self.buffer) >= JOURNAL_MAX_PENDING:
+            self.flush()
+        elif len(self.buffer) == 1 and self.on_pending:
+            self.on_pending()
+
+    def flush(self):
+        if self.f is None or not self.buffer:
+            return
+        try:
+            self.f.write("\n".join(self.buffer) + "\n")
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        except OSError:
+            # A journal that cannot be written is dropped rather than left half valid
+            self.f = None
+        self.buffer = []
+
+    def begin(self):
+        # Written lazily, so commands that record nothing leave no trace
+        self.pending_begin = True
+
+    def op(self, op: tuple):
+        if self.pending_begin:
+            self.pending_begin = False
+            self.append(["begin"])
+        self.append(self.encode(op))
+
+    def mark(self, kind: str):
+        self.pending_begin = False
+        self.append([kind])
+
+    def config(self, ids: Dict[str, Optional[int]]):
+        self.pending_begin = False
+        self.append(["config", ids])
+
+    def ref(self, d: Optional[CellItem]):
+        if d is None:
+            return None
+        n = self.number.get(id(d))
+        if n is not None:
+            return n
+        n = len(self.items)
+        self.items.append(d)
+        self.number[id(d)] = n
+        return {"n": n, "item": d.to_json()}
+
+    def encode(self, op: tuple) -> list:
+        kind = op[0]
+        if kind == "add":
+            return ["add", self.ref(op[1]), op[2], self.ref(op[3])]
+        if kind == "remove":
+            return ["remove", self.ref(op[1]), op[2]]
+        if kind == "set":
+            return ["set", self.ref(op[1])] + list(op[2:])
+        if kind == "move":
+            return ["move", self.ref(op[1]), op[2], list(op[3]), list(op[4]), self.ref(op[5])]
+        if kind == "clear":
+            # The cleared items are whatever is loaded when it is replayed
+            return ["clear"]
+        if kind == "remap":
+            return ["remap", [[self.ref(d), p, old, new] for d, p, old, new in op[1]], op[2], op[3]]
+        return list(op)
+
+    def item(self, ref) -> Optional[CellItem]:
+        if ref is None:
+            return None
+        if isinstance(ref, dict):
+            d = item_from_row(ref["item"])
+            if d is None or ref["n"] != len(self.items):
+                raise ValueError("Diario de cambios inconsistente")
+            self.items.append(d)
+            self.number[id(d)] = ref["n"]
+            return d
+        return self.items[ref]
+
+    def decode(self, entry: list) -> tuple:
+        """The op of an entry, other than "clear", with item numbers resolved."""
+        kind = entry[0]
+        if kind == "add":
+            return ("add", self.item(entry[1]), entry[2], self.item(entry[3]))
+        if kind == "remove":
+            return ("remove", self.item(entry[1]), entry[2])
+        if kind == "set":
+            return ("set", self.item(entry[1])) + tuple(entry[2:])
+        if kind == "move":
+            return ("move", self.item(entry[1]), entry[2], intern_pos(*entry[3]), intern_pos(*entry[4]), self.item(entry[5]))
+        if kind == "ids":
+            return ("ids", entry[1], entry[2])
+        if kind == "remap":
+            return ("remap", [(self.item(n), p, old, new) for n, p, old, new in entry[1]], entry[2], entry[3])
+        return tuple(entry)
+
+class Profiler:
+    """Opt-in call counts and wall-clock timings of named stages.
+
+    While disabled an instrumented call only checks `enabled`. Spans may be
+    recorded from worker threads; the trace keeps the last max_events of
+    them in Chrome trace format (chrome://tracing, Perfetto).
+    """
+
+    def __init__(self, max_events: int = 100_000):
+        self.enabled = False
+        self.stats: Dict[str, List[float]] = {}  # name -> [calls, total s, max s]
+        self.events: deque = deque(maxlen=max_events)
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.events.clear()
+            self.origin = time.perf_counter()
+
+    def record(self, name: str, start: float, end: float):
+        dur = end - start
+        with self.lock:
+            st = self.stats.get(name)
+            if st is None:
+                self.stats[name] = [1, dur, dur]
+            else:
+                st[0] += 1
+                st[1] += dur
+                if dur > st[2]:
+                    st[2] = dur
+            self.events.append((name, start, dur, threading.get_ident()))
+
+    @contextmanager
+    def span(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def summary(self) -> List[Tuple[str, int, float, float, float]]:
+        """(name, calls, total s, mean s, max s), slowest total first."""
+        with self.lock:
+            rows = [(name, int(n), tot, tot / n, mx) for name, (n, tot, mx) in self.stats.items()]
+        rows.sort(key=lambda r: r[2], reverse=True)
+        return rows
+
+    def trace(self) -> Dict:
+        with self.lock:
+            events = list(self.events)
+            origin = self.origin
+        pid = os.getpid()
+        return {
+            "traceEvents": [
+                {"name": name, "ph": "X", "ts": round((start - origin) * 1e6, 1), "dur": round(dur * 1e6, 1), "pid": pid, "tid": tid}
+                for name, start, dur, tid in events
+            ],
+            "summary": [
+                {"name": name, "calls": n, "total_ms": tot * 1000, "mean_ms": mean * 1000, "max_ms": mx * 1000}
+                for name, n, tot, mean, mx in self.summary()
+            ],
+        }
+
+    def export_trace(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.trace(), f, ensure_ascii=False)
+
+PROFILER = Profiler()
+
+def profiled(name: Optional[str] = None):
+    """Decorator recording each call of the function under name in PROFILER."""
+    def wrap(fn):
+        label = name or fn.__name__
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            if not PROFILER.enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                PROFILER.record(label, start, time.perf_counter())
+        return call
+    return wrap
+
+_TIPO_VAL_PERIODS = {"d": "dia", "s": "semana", "m": "mes", "a": "anio"}
+
+def _cod_fechas(root) -> list:
+    if isinstance(root, dict) and isinstance(root.get("formularioC"), list):
+        return root["formularioC"][0].get("cod_fechas", [])
+    return []
+
+def extract_global_ids(root) -> Dict[str, Optional[int]]:
+    """Period -> id_form declared in formularioC[0].cod_fechas."""
+    ids = {"dia": None, "semana": None, "mes": None, "anio": None}
+    try:
+        for e in _cod_fechas(root):
+            p = _TIPO_VAL_PERIODS.get(e.get("tipo_val"))
+            if p:
+                ids[p] = e.get("id_form")
+    except Exception:
+        pass
+    return ids
+
+def apply_global_ids(root, ids: Dict[str, Optional[int]]):
+    """Write the configured ids back into formularioC[0].cod_fechas."""
+    try:
+        for e in _cod_fechas(root):
+            p = _TIPO_VAL_PERIODS.get(e.get("tipo_val"))
+            if p and ids.get(p) is not None:
+                e["id_form"] = int(ids[p])
+    except Exception:
+        pass
+
+def id_form_counts(buckets: Dict[str, Dict[int, CellItem]]) -> Dict[str, Dict[int, int]]:
+    """Period -> id_form -> how many items of that period carry it."""
+    return {p: dict(Counter(d.id_form for d in bucket.values())) for p, bucket in buckets.items()}
+
+def plan_id_remap(buckets: Dict[str, Dict[int, CellItem]], maps: Dict[str, Dict[int, int]]) -> List[Tuple[CellItem, str, int, int]]:
+    """(item, period, old, new) for every item that the period's old -> new id_form map rewrites."""
+    changes = []
+    for p, m in maps.items():
+        m = {old: new for old, new in m.items() if old != new}
+        if m:
+            changes.extend((d, p, d.id_form, m[d.id_form]) for d in buckets.get(p, {}).values() if d.id_form in m)
+    return changes
+
+def remap_global_ids(ids: Dict[str, Optional[int]], maps: Dict[str, Dict[int, int]]) -> Dict[str, Optional[int]]:
+    # The cod_fechas ids follow their period's map like the items do
+    return {p: maps.get(p, {}).get(v, v) for p, v in ids.items()}
+
+def filter_by_global_ids(items: List[CellItem], ids: Dict[str, Optional[int]], sources: Optional[SourceIndex] = None) -> List[CellItem]:
+    # Strict filtering based on ID match as requested: "filtre cada valor... para que solo salgan los datos de este tipo"
+    valid_ids = {v for v in ids.values() if v is not None}
+    kept = []
+    for d in items:
+        if d.id_form in valid_ids:
+            kept.append(d)
+        elif sources is not None:
+            # Dropped rows leave the document on the next structured save
+            sources.mark(d, live=False)
+    return kept
+
+def write_closing_file(path: str, data, jsonl: bool = False, source: Optional[LazyDocument] = None):
+    if source is not None:
+        source.save(path, data, jsonl)
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        if jsonl:
+            for doc in data:
+                f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+        else:
+            json.dump(data, f, ensure_ascii=False, indent=2)
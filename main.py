@@ -1,94 +1,507 @@
+import os
 import sys
-import json
 import copy
-from dataclasses import dataclass
+from contextlib import contextmanager
 from typing import List, Dict, Optional, Tuple
-from PySide6.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QTableWidget, QTableWidgetItem, QListWidget, QListWidgetItem, QPushButton, QFileDialog, QLabel, QSplitter, QMessageBox, QFormLayout, QLineEdit, QGroupBox, QCheckBox, QScrollArea, QTabWidget, QSpinBox, QAbstractItemView, QDialog, QDialogButtonBox
-from PySide6.QtCore import Qt
+from PySide6.QtWidgets import QApplication, QMainWindow, QWidget, QTabBar, QVBoxLayout, QHBoxLayout, QTableView, QListView, QPushButton, QFileDialog, QLabel, QSplitter, QMessageBox, QFormLayout, QLineEdit, QGroupBox, QCheckBox, QScrollArea, QTabWidget, QSpinBox, QAbstractItemView, QDialog, QDialogButtonBox, QProgressBar, QTableWidget, QTableWidgetItem
+from PySide6.QtCore import Qt, QAbstractTableModel, QAbstractListModel, QModelIndex, QObject, QRunnable, QThreadPool, QTimer, Signal
 from PySide6.QtGui import QColor, QFont, QKeySequence, QShortcut
+from core import CellItem, PERIODS, code_period, intern_pos, fmt_pos, col_name, extract_global_ids, apply_global_ids, filter_by_global_ids, write_closing_file, open_closing_file, LazyDocument, classify_period, normalize_label, DuplicateIndex, SourceIndex, PeriodIndex, GroupIndex, SearchIndex, EditCommand, EditHistory, EditJournal, ClosingDiff, DiffEntry, diff_items, pack_state, unpack_state, id_form_counts, plan_id_remap, remap_global_ids, journal_dir, journal_path, read_journal, items_fingerprint, PROFILER, profiled
 
-@dataclass
-class CellItem:
-    id_form: int
-    label: str
-    codigo: str
-    tipo: int
-    deci: int
-    posicion: str
-    valor: str
-
-def parse_pos(pos: str) -> Tuple[int, int]:
-    r, c = pos.split(":")
-    return int(r), int(c)
-
-def fmt_pos(r: int, c: int) -> str:
-    return f"{r}:{c}"
-
-def col_name(idx: int) -> str:
-    s = ""
-    x = idx
-    while True:
-        s = chr(ord('A') + (x % 26)) + s
-        x = x // 26 - 1
-        if x < 0:
-            break
-    return s
+class WorkerSignals(QObject):
+    finished = Signal(object)
+    failed = Signal(str)
+    progress = Signal(object, object)
+
+class Worker(QRunnable):
+    """Runs fn(worker, *args) on the thread pool and reports back by signal.
+
+    fn must not touch widgets; it can call worker.report(done, total) and,
+    when started as cancellable, should poll worker.cancelled.
+    """
+
+    def __init__(self, fn, *args):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+        self.signals = WorkerSignals()
+
+    def report(self, done: int, total: int):
+        self.signals.progress.emit(done, total)
+
+    def run(self):
+        try:
+            result = self.fn(self, *self.args)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+        else:
+            self.signals.finished.emit(result)
+
+class ItemListModel(QAbstractListModel):
+    """Sidebar rows for the current search hits; row text is built on demand."""
+
+    def __init__(self):
+        super().__init__()
+        self.items: List[CellItem] = []
+        # id(item) -> row, rebuilt lazily after a removal
+        self.rows: Optional[Dict[int, int]] = {}
+
+    def set_items(self, items: List[CellItem]):
+        self.beginResetModel()
+        self.items = items
+        self.rows = None
+        self.endResetModel()
+
+    def item(self, row: int) -> Optional[CellItem]:
+        if 0 <= row < len(self.items):
+            return self.items[row]
+        return None
+
+    def row_of(self, d: CellItem) -> int:
+        if self.rows is None:
+            self.rows = {id(x): i for i, x in enumerate(self.items)}
+        return self.rows.get(id(d), -1)
+
+    def sync(self, d: CellItem, show: bool):
+        """Insert, remove or repaint the row of d to match one edit."""
+        row = self.row_of(d)
+        if show and row < 0:
+            n = len(self.items)
+            self.beginInsertRows(QModelIndex(), n, n)
+            self.items.append(d)
+            self.rows[id(d)] = n
+            self.endInsertRows()
+        elif not show and row >= 0:
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.items[row]
+            self.rows = None
+            self.endRemoveRows()
+        elif row >= 0:
+            idx = self.index(row)
+            self.dataChanged.emit(idx, idx, [Qt.DisplayRole])
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.items)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        d = self.items[index.row()]
+        disp = f"{d.codigo} | {d.label}"
+        if d.valor:
+            disp += f" | {d.valor}"
+        return disp
+
+def describe_diff(e: DiffEntry) -> str:
+    if e.kind == "added":
+        return f"Nuevo: {e.new.codigo}"
+    if e.kind == "removed":
+        return f"Eliminado: {e.old.codigo} | {e.old.label}"
+    lines = [f"Movido desde {fmt_pos(*e.old.posicion)}"] if e.kind == "moved" else []
+    lines += [f"{f}: {getattr(e.old, f)} → {getattr(e.new, f)}" for f in e.fields]
+    return "\n".join(lines)
+
+class PeriodTableModel(QAbstractTableModel):
+    """Sparse view of one period sheet.
+
+    Nothing is stored per cell: data() looks the cell up in the editor's
+    (posicion, period) index, so only the cells being painted are built.
+    While a comparison is shown, its entries are painted over the cells and
+    removed items appear struck out where they used to be.
+    """
+    DIFF_COLORS = {"added": "#2E7D32", "removed": "#3A3A4A", "moved": "#1565C0", "changed": "#B26A00"}
+
+    def __init__(self, editor: "GridEditor", period: str):
+        super().__init__()
+        self.editor = editor
+        self.period = period
+        self.n_rows = 0
+        self.n_cols = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.n_rows
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.n_cols
+
+    def item_at(self, r: int, c: int) -> Optional[CellItem]:
+        return self.editor.pos_to_item.get(((r, c), self.period))
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        d = self.item_at(index.row(), index.column())
+        diff = self.editor.visible_diff()
+        if d is None:
+            if diff is not None:
+                e = diff.removed.get(((index.row(), index.column()), self.period))
+                if e is not None and role != Qt.EditRole:
+                    return self.diff_data(e, role)
+            return "" if role in (Qt.DisplayRole, Qt.EditRole) else None
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return d.label
+        if role == Qt.UserRole:
+            return d.codigo
+        if diff is not None:
+            e = diff.by_item.get(id(d))
+            if e is not None:
+                return self.diff_data(e, role)
+        if self.editor.is_duplicate(d):
+            if role == Qt.BackgroundRole:
+                return QColor("#FF0000") # Strong red
+            if role == Qt.ForegroundRole:
+                return QColor("white")
+            if role == Qt.ToolTipRole:
+                return f"Código duplicado: {d.codigo}"
+        return None
+
+    def diff_data(self, e: DiffEntry, role):
+        removed = e.kind == "removed"
+        if role == Qt.DisplayRole:
+            return e.old.label if removed else None
+        if role == Qt.BackgroundRole:
+            return QColor(self.DIFF_COLORS[e.kind])
+        if role == Qt.ForegroundRole:
+            return QColor("#9E9E9E" if removed else "white")
+        if role == Qt.FontRole and removed:
+            font = QFont("Arial", 11)
+            font.setStrikeOut(True)
+            return font
+        if role == Qt.ToolTipRole:
+            return describe_diff(e)
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or not index.isValid():
+            return False
+        self.editor.on_cell_changed_tab(self.period, index.row(), index.column(), str(value))
+        return True
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return col_name(section)
+        return str(section + 1)
+
+    def reset_extent(self, rows: int, cols: int):
+        self.beginResetModel()
+        self.n_rows = rows
+        self.n_cols = cols
+        self.endResetModel()
+
+    def ensure_extent(self, rows: int, cols: int):
+        if rows > self.n_rows:
+            self.beginInsertRows(QModelIndex(), self.n_rows, rows - 1)
+            self.n_rows = rows
+            self.endInsertRows()
+        if cols > self.n_cols:
+            self.beginInsertColumns(QModelIndex(), self.n_cols, cols - 1)
+            self.n_cols = cols
+            self.endInsertColumns()
+
+    def shift_lines(self, axis: int, start: int, delta: int):
+        """Insert (delta > 0) or remove (delta < 0) rows/columns at start without a reset."""
+        count = self.n_rows if axis == 0 else self.n_cols
+        if delta > 0:
+            if start > count:
+                return
+            if axis == 0:
+                self.beginInsertRows(QModelIndex(), start, start + delta - 1)
+                self.n_rows += delta
+                self.endInsertRows()
+            else:
+                self.beginInsertColumns(QModelIndex(), start, start + delta - 1)
+                self.n_cols += delta
+                self.endInsertColumns()
+            return
+        last = min(start - delta, count) - 1
+        if start > last:
+            return
+        if axis == 0:
+            self.beginRemoveRows(QModelIndex(), start, last)
+            self.n_rows -= last - start + 1
+            self.endRemoveRows()
+        else:
+            self.beginRemoveColumns(QModelIndex(), start, last)
+            self.n_cols -= last - start + 1
+            self.endRemoveColumns()
+
+    def refresh_cell(self, r: int, c: int):
+        if 0 <= r < self.n_rows and 0 <= c < self.n_cols:
+            idx = self.index(r, c)
+            self.dataChanged.emit(idx, idx)
+
+    def refresh_range(self, r0: int, c0: int, r1: int, c1: int):
+        r1 = min(r1, self.n_rows - 1)
+        c1 = min(c1, self.n_cols - 1)
+        if r0 <= r1 and c0 <= c1:
+            self.dataChanged.emit(self.index(r0, c0), self.index(r1, c1))
+
+    def refresh_all(self):
+        if self.n_rows and self.n_cols:
+            self.dataChanged.emit(self.index(0, 0), self.index(self.n_rows - 1, self.n_cols - 1))
+
+class DiagnosticsDialog(QDialog):
+    """Call counts and timings collected by PROFILER, refreshed while open."""
+    COLUMNS = ("Operación", "Llamadas", "Total ms", "Media ms", "Máx ms")
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Diagnóstico de rendimiento")
+        self.resize(560, 420)
+        layout = QVBoxLayout(self)
+        self.enabled_box = QCheckBox("Medir tiempos")
+        self.enabled_box.setChecked(PROFILER.enabled)
+        self.enabled_box.toggled.connect(self.on_toggled)
+        layout.addWidget(self.enabled_box)
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        layout.addWidget(self.table, 1)
+        btns = QHBoxLayout()
+        reset_btn = QPushButton("Reiniciar")
+        reset_btn.clicked.connect(self.on_reset)
+        export_btn = QPushButton("Exportar traza...")
+        export_btn.clicked.connect(self.on_export)
+        close_btn = QPushButton("Cerrar")
+        close_btn.clicked.connect(self.close)
+        btns.addWidget(reset_btn)
+        btns.addWidget(export_btn)
+        btns.addStretch(1)
+        btns.addWidget(close_btn)
+        layout.addLayout(btns)
+        self.timer = QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start()
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        super().hideEvent(event)
+
+    def on_toggled(self, on: bool):
+        PROFILER.enabled = on
+
+    def on_reset(self):
+        PROFILER.reset()
+        self.refresh()
+
+    def on_export(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Exportar traza", "traza.json", "JSON (*.json)")
+        if not path:
+            return
+        try:
+            PROFILER.export_trace(path)
+        except OSError as e:
+            QMessageBox.critical(self, "Error", str(e))
+
+    def refresh(self):
+        rows = PROFILER.summary()
+        self.table.setRowCount(len(rows))
+        for r, (name, calls, total, mean, mx) in enumerate(rows):
+            cells = (name, str(calls), f"{total * 1000:.1f}", f"{mean * 1000:.2f}", f"{mx * 1000:.1f}")
+            for c, txt in enumerate(cells):
+                item = QTableWidgetItem(txt)
+                if c:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(r, c, item)
+
+class IdRemapDialog(QDialog):
+    """Old -> new id_form for each period, previewing how many items change."""
+    COLUMNS = ("Periodo", "id_form", "Items", "Nuevo id_form")
+
+    def __init__(self, counts: Dict[str, Dict[int, int]], global_ids: Dict[str, Optional[int]], parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Reasignar IDs")
+        self.resize(520, 420)
+        layout = QVBoxLayout(self)
+        layout.addWidget(QLabel("Escriba el nuevo id_form junto a cada id que quiera reemplazar."))
+        self.rows = [(p, fid, n) for p in PERIODS for fid, n in sorted(counts.get(p, {}).items(), key=lambda kv: str(kv[0]))]
+        self.table = QTableWidget(len(self.rows), len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        titles = {"dia": "Día", "semana": "Semana", "mes": "Mes", "anio": "Año"}
+        for r, (p, fid, n) in enumerate(self.rows):
+            cells = (titles.get(p, p), f"{fid} (global)" if global_ids.get(p) == fid else str(fid), str(n))
+            for c, txt in enumerate(cells):
+                item = QTableWidgetItem(txt)
+                item.setFlags(Qt.ItemIsEnabled)
+                if c == 2:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(r, c, item)
+            self.table.setItem(r, 3, QTableWidgetItem(""))
+        self.table.itemChanged.connect(self.update_preview)
+        layout.addWidget(self.table, 1)
+        self.preview = QLabel()
+        layout.addWidget(self.preview)
+        btns = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        btns.accepted.connect(self.accept)
+        btns.rejected.connect(self.reject)
+        layout.addWidget(btns)
+        self.update_preview()
+
+    def maps(self) -> Dict[str, Dict[int, int]]:
+        out: Dict[str, Dict[int, int]] = {}
+        for r, (p, fid, _) in enumerate(self.rows):
+            txt = self.table.item(r, 3).text().strip()
+            if txt.isdigit() and int(txt) != fid:
+                out.setdefault(p, {})[fid] = int(txt)
+        return out
+
+    def update_preview(self):
+        maps = self.maps()
+        n = sum(count for p, fid, count in self.rows if fid in maps.get(p, {}))
+        self.preview.setText(f"{n} items cambiarán ({sum(len(m) for m in maps.values())} ids reemplazados)")
+
+class OpenDocument:
+    """A closing file of the workspace while another one is in the editor.
+
+    state holds the editor attributes of the document as they were left. An
+    evicted document keeps them packed in blob instead, minus the indexes,
+    which are rebuilt from its items when it is selected again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state: Optional[Dict] = None
+        self.blob: Optional[bytes] = None
+        # Kept apart from the blob: the mapped source file and the journal's path
+        self.source: Optional[LazyDocument] = None
+        self.journal_path: Optional[str] = None
+        self.modified = False
+        self.used = 0
 
 class GridEditor(QMainWindow):
+    # Past this many sidebar rows touched in one batch, the list is requeried instead
+    LIST_RESYNC = 200
+    # Editor attributes that belong to the open document and are swapped with the tab
+    DOC_FIELDS = ("root_data", "source_jsonl", "sources", "items", "items_by_codigo", "pos_to_item", "periods",
+                  "groups", "dups", "search", "global_ids", "history", "journal", "saved_command", "current_codigo", "diff")
+    # Left out of an evicted document and rebuilt from its items
+    DOC_INDEXES = ("periods", "groups", "dups", "search")
+    # Documents kept unpacked, the active one included
+    RESIDENT_DOCUMENTS = 2
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Cierres Maker")
         self.items: List[CellItem] = []
         self.items_by_codigo: Dict[str, CellItem] = {}
-        self.pos_to_item: Dict[str, CellItem] = {}
+        self.pos_to_item: Dict[Tuple[Tuple[int, int], str], CellItem] = {}
         self.current_codigo: Optional[str] = None
-        self.groups: Dict[str, Dict[str, CellItem]] = {}
+        self.periods = PeriodIndex(lambda d: classify_period(d, self.global_ids))
+        self.groups = GroupIndex(self.periods)
         self.root_data = None
+        self.source_jsonl = False
+        self.sources = SourceIndex()
         self.global_ids: Dict[str, Optional[int]] = {"dia": None, "semana": None, "mes": None, "anio": None}
         self.updating = False
-        self.undo_stack = []
-        self.redo_stack = []
+        self.history = EditHistory()
+        # Newest command with ops when the document was loaded or saved
+        self.saved_command: Optional[EditCommand] = None
+        # Comparison against another closing file, painted over the sheets
+        self.diff: Optional[ClosingDiff] = None
+        self.documents: List[OpenDocument] = []
+        self.active_doc: Optional[OpenDocument] = None
+        self.doc_uses = 0
+        # Crash recovery: the history is mirrored to disk and written in batches
+        self.journal: Optional[EditJournal] = None
+        self.journal_timer = QTimer(self)
+        self.journal_timer.setSingleShot(True)
+        self.journal_timer.setInterval(1000)
+        self.journal_timer.timeout.connect(self.flush_journal)
         self.copied_data: Optional[Dict] = None
-
+        self.dups = DuplicateIndex()
+        # Inside batched(): repaints, extent growth and sidebar syncs wait for the end
+        self.batch_depth = 0
+        self.pending_cells: Dict[str, Tuple[int, int, int, int]] = {}
+        self.pending_extent = (0, 0)
+        self.pending_list: Dict[int, CellItem] = {}
+
+        self.doc_tabs = QTabBar()
+        self.doc_tabs.setTabsClosable(True)
+        self.doc_tabs.setExpanding(False)
+        self.doc_tabs.currentChanged.connect(self.on_document_tab_changed)
+        self.doc_tabs.tabCloseRequested.connect(self.close_document)
+        self.doc_tabs.hide()
         self.tabs = QTabWidget()
         self.tabs.currentChanged.connect(self.on_tab_changed)
-        self.tables: Dict[str, QTableWidget] = {}
+        self.tables: Dict[str, QTableView] = {}
+        self.models: Dict[str, PeriodTableModel] = {}
         self.current_period: str = "dia"
         self.init_table_for_period("dia")
 
-        self.list = QListWidget()
-        self.list.currentRowChanged.connect(self.on_list_change)
+        self.search = SearchIndex(self.periods)
+        self.list_model = ItemListModel()
+        self.list_query = ""
+        self.list = QListView()
+        self.list.setUniformItemSizes(True)
+        self.list.setModel(self.list_model)
+        self.list.selectionModel().currentRowChanged.connect(lambda cur, _: self.on_list_change(cur.row()))
 
         self.load_btn = QPushButton("Cargar JSON")
         self.load_btn.clicked.connect(self.on_load_json)
 
         self.save_btn = QPushButton("Guardar JSON")
         self.save_btn.clicked.connect(self.on_save_json)
+        self.keep_structure = QCheckBox("Conservar estructura original")
+        self.keep_structure.setChecked(True)
 
         self.add_row_btn = QPushButton("Agregar Fila")
         self.add_row_btn.clicked.connect(self.on_insert_row)
         self.add_col_btn = QPushButton("Agregar Columna")
         self.add_col_btn.clicked.connect(self.on_insert_col)
+        self.del_row_btn = QPushButton("Eliminar Fila")
+        self.del_row_btn.clicked.connect(self.on_delete_row)
+        self.del_col_btn = QPushButton("Eliminar Columna")
+        self.del_col_btn.clicked.connect(self.on_delete_col)
+        # How many rows/columns the insert and delete buttons act on
+        self.span_spin = QSpinBox()
+        self.span_spin.setRange(1, 1000)
+        self.span_spin.setValue(1)
         
         self.undo_btn = QPushButton("Deshacer")
         self.undo_btn.clicked.connect(self.undo)
         self.redo_btn = QPushButton("Rehacer")
         self.redo_btn.clicked.connect(self.redo)
         
-        self.copy_btn = QPushButton("Copiar Celda")
+        self.copy_btn = QPushButton("Copiar")
         self.copy_btn.clicked.connect(self.copy_selection)
-        self.paste_btn = QPushButton("Pegar Celda")
+        self.paste_btn = QPushButton("Pegar")
         self.paste_btn.clicked.connect(self.paste_selection)
+        self.fill_btn = QPushButton("Rellenar")
+        self.fill_btn.clicked.connect(lambda: self.fill_selection(0))
+        self.delete_btn = QPushButton("Borrar")
+        self.delete_btn.clicked.connect(self.delete_selection)
         
         self.clear_btn = QPushButton("Limpiar")
         self.clear_btn.clicked.connect(self.on_clear_all)
+        self.diag_btn = QPushButton("Diagnóstico")
+        self.diag_btn.clicked.connect(self.show_diagnostics)
+        self.diagnostics: Optional[DiagnosticsDialog] = None
         
-        QShortcut(QKeySequence("Ctrl+Z"), self, self.undo)
-        QShortcut(QKeySequence("Ctrl+Y"), self, self.redo)
-        QShortcut(QKeySequence("Ctrl+Shift+Z"), self, self.redo)
-        QShortcut(QKeySequence("Ctrl+C"), self, self.copy_selection)
-        QShortcut(QKeySequence("Ctrl+V"), self, self.paste_selection)
-        QShortcut(QKeySequence("Delete"), self, self.delete_selection)
+        self.shortcuts = [
+            QShortcut(QKeySequence("Ctrl+Z"), self, self.undo),
+            QShortcut(QKeySequence("Ctrl+Y"), self, self.redo),
+            QShortcut(QKeySequence("Ctrl+Shift+Z"), self, self.redo),
+            QShortcut(QKeySequence("Ctrl+C"), self, self.copy_selection),
+            QShortcut(QKeySequence("Ctrl+V"), self, self.paste_selection),
+            QShortcut(QKeySequence("Delete"), self, self.delete_selection),
+            QShortcut(QKeySequence("Ctrl+D"), self, lambda: self.fill_selection(0)),
+            QShortcut(QKeySequence("Ctrl+R"), self, lambda: self.fill_selection(1)),
+        ]
 
         self.move_mode = QCheckBox("Mover grupo con clic")
         self.move_mode.setChecked(False)
@@ -111,6 +524,13 @@ class GridEditor(QMainWindow):
         
         self.config_ids_btn = QPushButton("Configurar IDs Globales")
         self.config_ids_btn.clicked.connect(self.prompt_global_ids)
+        self.compare_btn = QPushButton("Comparar...")
+        self.compare_btn.clicked.connect(self.on_compare)
+        self.diff_box = QCheckBox("Mostrar diferencias")
+        self.diff_box.setEnabled(False)
+        self.diff_box.toggled.connect(lambda _: self.update_diff_view())
+        self.remap_ids_btn = QPushButton("Reasignar IDs...")
+        self.remap_ids_btn.clicked.connect(self.on_remap_ids)
 
         self.detail_box = QGroupBox("Detalle celda")
         self.det_label = QLineEdit()
@@ -144,12 +564,18 @@ class GridEditor(QMainWindow):
         self.save_btn.setText("💾 Guardar JSON")
         self.add_row_btn.setText("➕ Agregar Fila")
         self.add_col_btn.setText("📊 Agregar Columna")
+        self.del_row_btn.setText("➖ Eliminar Fila")
+        self.del_col_btn.setText("✂️ Eliminar Columna")
         self.undo_btn.setText("🗑️ Deshacer")
         self.redo_btn.setText("♻️ Rehacer")
-        self.copy_btn.setText("📋 Copiar Celda")
-        self.paste_btn.setText("📌 Pegar Celda")
+        self.copy_btn.setText("📋 Copiar")
+        self.paste_btn.setText("📌 Pegar")
+        self.fill_btn.setText("⬇️ Rellenar")
+        self.delete_btn.setText("❌ Borrar")
         self.clear_btn.setText("🧹 Limpiar")
+        self.diag_btn.setText("⏱️ Diagnóstico")
         self.move_mode.setText("👥 Mover grupo con clic")
+        self.compare_btn.setText("🆚 Comparar...")
 
         # Header
         header = QWidget()
@@ -191,7 +617,12 @@ class GridEditor(QMainWindow):
         search_icon = QLabel("🔍")
         self.search_entry = QLineEdit()
         self.search_entry.setPlaceholderText("Buscar en datos...")
-        self.search_entry.textChanged.connect(self.on_search_changed)
+        # Debounced: the query runs once typing pauses
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(lambda: self.on_search_changed(self.search_entry.text()))
+        self.search_entry.textChanged.connect(self.search_timer.start)
         self.search_entry.returnPressed.connect(self.on_search_return)
         sb_layout.addWidget(search_icon)
         sb_layout.addWidget(self.search_entry)
@@ -207,6 +638,7 @@ class GridEditor(QMainWindow):
         ids_layout.addWidget(self.ids_box)
         ids_layout.addWidget(self.update_ids_btn)
         ids_layout.addWidget(self.config_ids_btn)
+        ids_layout.addWidget(self.remap_ids_btn)
 
         # Left sidebar (actions + list)
         left_controls = QWidget()
@@ -214,14 +646,26 @@ class GridEditor(QMainWindow):
         left_controls_layout.setContentsMargins(8, 8, 8, 8)
         left_controls_layout.addWidget(self.load_btn)
         left_controls_layout.addWidget(self.save_btn)
+        left_controls_layout.addWidget(self.keep_structure)
         left_controls_layout.addWidget(self.add_row_btn)
         left_controls_layout.addWidget(self.add_col_btn)
+        left_controls_layout.addWidget(self.del_row_btn)
+        left_controls_layout.addWidget(self.del_col_btn)
+        span_row = QHBoxLayout()
+        span_row.addWidget(QLabel("Cantidad:"))
+        span_row.addWidget(self.span_spin)
+        left_controls_layout.addLayout(span_row)
         left_controls_layout.addWidget(self.undo_btn)
         left_controls_layout.addWidget(self.redo_btn)
         left_controls_layout.addWidget(self.copy_btn)
         left_controls_layout.addWidget(self.paste_btn)
+        left_controls_layout.addWidget(self.fill_btn)
+        left_controls_layout.addWidget(self.delete_btn)
         left_controls_layout.addWidget(self.clear_btn)
+        left_controls_layout.addWidget(self.diag_btn)
         left_controls_layout.addWidget(self.move_mode)
+        left_controls_layout.addWidget(self.compare_btn)
+        left_controls_layout.addWidget(self.diff_box)
         left_controls_layout.addWidget(self.current_label)
 
         left_splitter = QSplitter(Qt.Vertical)
@@ -246,9 +690,16 @@ class GridEditor(QMainWindow):
         right_scroll.setWidget(right_panel)
         right_scroll.setMinimumWidth(240)
 
+        sheets = QWidget()
+        sheets_layout = QVBoxLayout(sheets)
+        sheets_layout.setContentsMargins(0, 0, 0, 0)
+        sheets_layout.setSpacing(0)
+        sheets_layout.addWidget(self.doc_tabs)
+        sheets_layout.addWidget(self.tabs, 1)
+
         splitter = QSplitter()
         splitter.addWidget(left_scroll)
-        splitter.addWidget(self.tabs)
+        splitter.addWidget(sheets)
         splitter.addWidget(right_scroll)
         splitter.setStretchFactor(0, 0)
         splitter.setStretchFactor(1, 1)
@@ -262,37 +713,60 @@ class GridEditor(QMainWindow):
         root_layout.addWidget(toolbar)
         root_layout.addWidget(splitter, 1)
         self.setCentralWidget(root)
+
+        self.progress = QProgressBar()
+        self.progress.setMaximumWidth(240)
+        self.cancel_btn = QPushButton("Cancelar")
+        self.cancel_btn.clicked.connect(self.on_cancel_progress)
+        self.statusBar().addPermanentWidget(self.progress)
+        self.statusBar().addPermanentWidget(self.cancel_btn)
+        self.progress.hide()
+        self.cancel_btn.hide()
+        self.pool = QThreadPool.globalInstance()
+        self.worker: Optional[Worker] = None
+        self.busy = False
         self.setStyleSheet(
             "QWidget{background:#0A0E27; color:#fff;}"
             "QScrollArea{background:#0A0E27; border:0;}"
             "QSplitter::handle{background:#1E1E2E;}"
             "QGroupBox{background:#1E1E2E; border:1px solid #2D2D44; padding:8px; margin-top:10px;}"
             "QGroupBox::title{subcontrol-origin: margin; left:10px; padding:0 6px;}"
-            "QTableWidget{background:#1E1E2E; color:#fff; gridline-color:#2D2D44; selection-background-color: #5865F2; selection-color: #fff;}"
-            "QTableWidget::item:selected{background:#5865F2; color:#fff;}"
-            "QTableWidget::item:selected:!active{background:#5865F2; color:#fff;}"
-            "QTableWidget::item{padding:4px; border:0px;}"
+            "QTableView{background:#1E1E2E; color:#fff; gridline-color:#2D2D44; selection-background-color: #5865F2; selection-color: #fff;}"
+            "QTableView::item:selected{background:#5865F2; color:#fff;}"
+            "QTableView::item:selected:!active{background:#5865F2; color:#fff;}"
+            "QTableView::item{padding:4px; border:0px;}"
             "QHeaderView::section{background:#2D2D44; color:#fff; border:0; padding:6px;}"
             "QPushButton{background:#5865F2; color:#fff; border:0; padding:8px; font-weight:bold;}"
             "QPushButton:hover{background:#4752C4;}"
-            "QListWidget{background:#1E1E2E; color:#fff; border:0;}"
+            "QListView{background:#1E1E2E; color:#fff; border:0;}"
             "QLineEdit{background:#2D2D44; color:#fff; border:0; padding:8px;}"
             "QLabel{color:#fff;}"
         )
     
+    def show_diagnostics(self):
+        # Non-modal, so timings keep updating while the editor is used
+        if self.diagnostics is None:
+            self.diagnostics = DiagnosticsDialog(self)
+        self.diagnostics.show()
+        self.diagnostics.raise_()
+
     def period_title(self, p: str) -> str:
         return {"dia": "Día", "semana": "Semana", "mes": "Mes", "anio": "Año"}.get(p, p.capitalize())
     
     def init_table_for_period(self, period: str):
         if period in self.tables:
             return
-        tbl = QTableWidget()
-        tbl.setSelectionBehavior(QTableWidget.SelectItems)
-        tbl.setSelectionMode(QTableWidget.SingleSelection)
+        model = PeriodTableModel(self, period)
+        tbl = QTableView()
+        tbl.setModel(model)
+        tbl.setSelectionBehavior(QTableView.SelectItems)
+        tbl.setSelectionMode(QTableView.ContiguousSelection)
         tbl.setFont(QFont("Arial", 11))
+        tbl.verticalHeader().setDefaultSectionSize(24)
+        tbl.horizontalHeader().setDefaultSectionSize(120)
         tbl.setProperty("period", period)
-        tbl.cellClicked.connect(lambda r, c, p=period: self.on_cell_clicked_tab(p, r, c))
-        tbl.cellChanged.connect(lambda r, c, p=period: self.on_cell_changed_tab(p, r, c))
+        tbl.clicked.connect(lambda idx, p=period: self.on_cell_clicked_tab(p, idx.row(), idx.column()))
+        self.models[period] = model
         self.tables[period] = tbl
         self.tabs.addTab(tbl, self.period_title(period))
         # Point helpers to the active table
@@ -353,43 +827,320 @@ class GridEditor(QMainWindow):
         self.table = self.tables[period]
         self.on_cell_clicked(r0, c0)
     
-    def on_cell_changed_tab(self, period: str, r: int, c: int):
+    def on_cell_changed_tab(self, period: str, r: int, c: int, txt: str):
         self.current_period = period
         self.table = self.tables[period]
-        self.on_cell_changed(r, c)
+        self.on_cell_changed(r, c, txt)
+
+    def current_cell(self) -> Tuple[int, int]:
+        idx = self.table.currentIndex()
+        if not idx.isValid():
+            return -1, -1
+        return idx.row(), idx.column()
+
+    def select_cell(self, r: int, c: int):
+        model = self.models[self.current_period]
+        if 0 <= r < model.rowCount() and 0 <= c < model.columnCount():
+            idx = model.index(r, c)
+            # Re-selecting the current cell would collapse a shift-click range
+            if self.table.currentIndex() != idx:
+                self.table.setCurrentIndex(idx)
+
+    def selected_range(self) -> Optional[Tuple[int, int, int, int]]:
+        # (top, left, bottom, right) of the table selection, or of the current cell
+        ranges = list(self.table.selectionModel().selection())
+        if not ranges:
+            r, c = self.current_cell()
+            return (r, c, r, c) if r >= 0 and c >= 0 else None
+        return (min(x.top() for x in ranges), min(x.left() for x in ranges),
+                max(x.bottom() for x in ranges), max(x.right() for x in ranges))
+
+    def refresh_cell(self, period: str, r: int, c: int):
+        if self.batch_depth:
+            box = self.pending_cells.get(period)
+            self.pending_cells[period] = (r, c, r, c) if box is None else (
+                min(box[0], r), min(box[1], c), max(box[2], r), max(box[3], c))
+            return
+        model = self.models.get(period)
+        if model:
+            model.refresh_cell(r, c)
 
+    def ensure_extent(self, rows: int, cols: int):
+        if self.batch_depth:
+            self.pending_extent = (max(self.pending_extent[0], rows), max(self.pending_extent[1], cols))
+            return
+        for model in self.models.values():
+            model.ensure_extent(rows, cols)
+
+    @contextmanager
+    def batched(self):
+        """Group many item changes so the views and sidebar catch up once at the end."""
+        self.batch_depth += 1
+        try:
+            yield
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth:
+                self.flush_batch()
+
+    def flush_batch(self):
+        rows, cols = self.pending_extent
+        self.pending_extent = (0, 0)
+        if rows or cols:
+            self.ensure_extent(rows, cols)
+        boxes, self.pending_cells = self.pending_cells, {}
+        for period, box in boxes.items():
+            model = self.models.get(period)
+            if model:
+                model.refresh_range(*box)
+        touched, self.pending_list = self.pending_list, {}
+        if len(touched) > self.LIST_RESYNC:
+            self.list_model.set_items(self.search.search(self.current_period, self.list_query))
+        else:
+            for d in touched.values():
+                self.sync_list_item(d)
+
+    @profiled()
     def save_state(self):
-        state = {
-            'items': copy.deepcopy(self.items),
-            'global_ids': copy.deepcopy(self.global_ids)
-        }
-        self.undo_stack.append(state)
-        if len(self.undo_stack) > 50:
-            self.undo_stack.pop(0)
-        self.redo_stack.clear()
-
-    def restore_state(self, state):
-        self.items = copy.deepcopy(state['items'])
-        self.global_ids = copy.deepcopy(state['global_ids'])
-        self.items_by_codigo = {d.codigo: d for d in self.items}
-        
-        self.pos_to_item = {}
+        # Open a new command; the mutation helpers below record into it
+        self.history.begin()
+
+    def add_item(self, d: CellItem, period: str):
+        displaced = self.pos_to_item.get((d.posicion, period))
+        self.history.record(("add", d, period, displaced))
+        self._insert_item(d, period)
+
+    def remove_item(self, d: CellItem, period: str):
+        self.history.record(("remove", d, period))
+        self._drop_item(d, period)
+
+    def remove_items(self, pairs: List[Tuple[CellItem, str]]):
+        for d, period in pairs:
+            self.history.record(("remove", d, period))
+        self._drop_items(pairs)
+
+    def set_item_field(self, d: CellItem, period: str, field: str, value):
+        old = getattr(d, field)
+        if old == value:
+            return
+        if field == "posicion":
+            displaced = self.pos_to_item.get((value, period))
+            self.history.record(("move", d, period, old, value, displaced))
+            self._move_item(d, period, old, value, None)
+            return
+        self.history.record(("set", d, period, field, old, value))
+        self._assign_field(d, period, field, value)
+
+    def set_global_ids(self, ids: Dict[str, Optional[int]]):
+        # The usual case from on_update_ids; reclassifying would visit every item for nothing
+        if dict(ids) == self.global_ids:
+            return
+        self.history.record(("ids", dict(self.global_ids), dict(ids)))
+        self.global_ids = dict(ids)
+        self.apply_global_ids_to_root()
+        self.reclassify_periods()
+
+    def remap_ids(self, changes: List[Tuple[CellItem, str, int, int]], ids: Dict[str, Optional[int]]):
+        self.history.record(("remap", changes, dict(self.global_ids), dict(ids)))
+        self._remap_ids(changes, ids, False)
+
+    def reclassify_periods(self):
+        # Items with a period code prefix never follow the ids, so only the rest are revisited
+        for d in self.periods.reclassify():
+            self.groups.update(d)
+        self.search.invalidate()
+        self.refresh_list()
+
+    def shift_positions(self, axis: int, start: int, delta: int):
+        self.history.record(("shift", axis, start, delta))
+        self._shift_positions(axis, start, delta)
+
+    def _insert_item(self, d: CellItem, period: str):
+        self.items.append(d)
+        self.sources.mark(d, period)
+        self.periods.add(d)
+        self.groups.add(d)
+        self.search.update(d)
+        self.sync_list_item(d)
+        self.pos_to_item[(d.posicion, period)] = d
+        if d.codigo:
+            self.items_by_codigo[d.codigo] = d
+        self.track_duplicates(d)
+        r, c = d.posicion
+        self.ensure_extent(r + 1, c + 1)
+        self.refresh_cell(period, r, c)
+
+    def _drop_item(self, d: CellItem, period: str):
+        for i in range(len(self.items) - 1, -1, -1):
+            if self.items[i] is d:
+                del self.items[i]
+                break
+        self._unindex_item(d, period)
+
+    def _drop_items(self, pairs: List[Tuple[CellItem, str]]):
+        # One pass over the item list for many (item, period) pairs
+        gone = {id(d) for d, _ in pairs}
+        self.items = [d for d in self.items if id(d) not in gone]
+        for d, period in pairs:
+            self._unindex_item(d, period)
+
+    def _unindex_item(self, d: CellItem, period: str):
+        self.sources.mark(d, period, False)
+        self.search.remove(d)
+        self.groups.remove(d)
+        self.periods.remove(d)
+        self.sync_list_item(d)
+        if self.pos_to_item.get((d.posicion, period)) is d:
+            del self.pos_to_item[(d.posicion, period)]
+        if d.codigo and self.items_by_codigo.get(d.codigo) is d:
+            del self.items_by_codigo[d.codigo]
+        self.untrack_duplicates(d)
+        r, c = d.posicion
+        self.refresh_cell(period, r, c)
+
+    def _assign_field(self, d: CellItem, period: str, field: str, value):
+        if field == "codigo":
+            if d.codigo and self.items_by_codigo.get(d.codigo) is d:
+                del self.items_by_codigo[d.codigo]
+            d.codigo = value
+            if value:
+                self.items_by_codigo[value] = d
+            self.retrack_duplicates(d)
+        else:
+            setattr(d, field, value)
+        self.sources.mark(d, period)
+        if field in ("codigo", "label", "valor", "id_form"):
+            old = self.periods.bucket_of(d)
+            if field != "valor":
+                self.periods.update(d)
+                self.groups.update(d)
+            self.search.update(d, old)
+            self.sync_list_item(d)
+        r, c = d.posicion
+        self.refresh_cell(period, r, c)
+
+    def _move_item(self, d: CellItem, period: str, old: Tuple[int, int], new: Tuple[int, int], restore: Optional[CellItem]):
+        # restore is the item that was displaced from old when d first moved there
+        if self.pos_to_item.get((old, period)) is d:
+            del self.pos_to_item[(old, period)]
+        if restore is not None:
+            self.pos_to_item[(old, period)] = restore
+        d.posicion = new
+        self.groups.move(d, old, new)
+        self.pos_to_item[(new, period)] = d
+        self.sources.mark(d, period)
+        r, c = new
+        self.ensure_extent(r + 1, c + 1)
+        self.refresh_cell(period, r, c)
+        self.refresh_cell(period, *old)
+
+    def _remap_ids(self, changes: List[Tuple[CellItem, str, int, int]], ids: Dict[str, Optional[int]], undo: bool):
+        # id_form is not shown in the sheets, so only the period indexes need to follow
+        for d, period, old, new in changes:
+            d.id_form = old if undo else new
+            self.sources.mark(d, period)
+        self.global_ids = dict(ids)
+        self.apply_global_ids_to_root()
+        self.reclassify_periods()
+
+    def _shift_positions(self, axis: int, start: int, delta: int):
+        # Along axis (0 rows, 1 cols): delta > 0 opens delta lines at start, delta < 0
+        # closes [start, start - delta), whose items must already be removed
+        lo = start if delta > 0 else start - delta
+        # Positions are interned, so each distinct one is remapped once
+        remap: Dict[Tuple[int, int], Tuple[int, int]] = {}
         for d in self.items:
-            p = self.get_period(d) or "dia"
-            self.pos_to_item[(d.posicion, p)] = d
+            pos = d.posicion
+            if pos[axis] >= lo:
+                new = remap.get(pos)
+                if new is None:
+                    r, c = pos
+                    new = remap[pos] = intern_pos(r + delta, c) if axis == 0 else intern_pos(r, c + delta)
+                d.posicion = new
+        if remap:
+            self.pos_to_item = {(remap.get(pos, pos), p): d for (pos, p), d in self.pos_to_item.items()}
+            self.sources.touch_positions()
+        self.groups.shift(axis, start, delta)
+        # The views shift their own rows, selection and scroll position
+        for model in self.models.values():
+            model.shift_lines(axis, start, delta)
+
+    def apply_op(self, op: tuple, undo: bool):
+        kind = op[0]
+        if kind == "add":
+            if undo:
+                self._drop_item(op[1], op[2])
+                if op[3] is not None:
+                    self.pos_to_item[(op[1].posicion, op[2])] = op[3]
+            else:
+                self._insert_item(op[1], op[2])
+        elif kind == "remove":
+            if undo:
+                self._insert_item(op[1], op[2])
+            else:
+                self._drop_item(op[1], op[2])
+        elif kind == "set":
+            _, d, period, field, old, new = op
+            self._assign_field(d, period, field, old if undo else new)
+        elif kind == "move":
+            _, d, period, old, new, displaced = op
+            if undo:
+                self._move_item(d, period, new, old, displaced)
+            else:
+                self._move_item(d, period, old, new, None)
+        elif kind == "shift":
+            _, axis, start, delta = op
+            self._shift_positions(axis, start, -delta if undo else delta)
+        elif kind == "ids":
+            self.global_ids = dict(op[1] if undo else op[2])
+            self.apply_global_ids_to_root()
+            self.reclassify_periods()
+        elif kind == "remap":
+            _, changes, old_ids, new_ids = op
+            self._remap_ids(changes, old_ids if undo else new_ids, undo)
+        elif kind == "clear":
+            _, old_items, old_map = op
+            if undo:
+                self.items = list(old_items)
+                self.items_by_codigo = {d.codigo: d for d in self.items}
+                self.pos_to_item = dict(old_map)
+                for (_, p), d in old_map.items():
+                    self.sources.mark(d, p)
+                self.periods.rebuild(self.items)
+                self.groups.rebuild(self.items)
+                self.search.rebuild(self.items)
+                self.refresh_list()
+                self.update_duplicates()
+                self.render_from_items()
+            else:
+                self._clear_items()
+
+    @profiled()
+    def restore_state(self, cmd: EditCommand, undo: bool):
+        ops = reversed(cmd.ops) if undo else cmd.ops
+        with self.batched():
+            # Runs of removals (and of undone adds that displaced nothing) share one pass over the item list
+            drops = []
+            for op in ops:
+                if (op[0] == "remove" and not undo) or (op[0] == "add" and undo and op[3] is None):
+                    drops.append((op[1], op[2]))
+                    continue
+                if drops:
+                    self._drop_items(drops)
+                    drops = []
+                self.apply_op(op, undo)
+            if drops:
+                self._drop_items(drops)
             
-        self.build_groups()
-        self.refresh_list()
-        self.render_from_items()
-        self.update_duplicates()
+        if hasattr(self, "count_label") and self.count_label:
+            self.count_label.setText(f"{len(self.items)} Items | Cargados")
         
         # Restore selection if possible
         if self.current_codigo and self.current_codigo in self.items_by_codigo:
             item = self.items_by_codigo[self.current_codigo]
-            r, c = parse_pos(item.posicion)
+            r, c = item.posicion
             p = self.get_period(item) or "dia"
             if p in self.tables:
-                idx = [self.tables[t].property("period") for t in self.tables].index(p) if p in self.tables else 0
                 # ensure tab is active
                 for i in range(self.tabs.count()):
                     w = self.tabs.widget(i)
@@ -397,63 +1148,38 @@ class GridEditor(QMainWindow):
                         self.tabs.setCurrentIndex(i)
                         break
                 self.table = self.tables[p]
-                self.table.setCurrentCell(r, c)
+                self.select_cell(r, c)
             self.show_cell_details(r, c)
             self.fill_id_fields(item)
         else:
             # If current selection is gone, try to keep table selection or clear details
-            r = self.table.currentRow()
-            c = self.table.currentColumn()
+            r, c = self.current_cell()
             if r >= 0 and c >= 0:
                 self.show_cell_details(r, c)
             else:
                 self.fill_id_fields(None)
 
     def undo(self):
-        if not self.undo_stack:
-            return
-        
-        current_state = {
-            'items': copy.deepcopy(self.items),
-            'global_ids': copy.deepcopy(self.global_ids)
-        }
-        self.redo_stack.append(current_state)
-        
-        state = self.undo_stack.pop()
-        self.restore_state(state)
+        cmd = self.history.pop_undo()
+        if cmd:
+            self.restore_state(cmd, undo=True)
 
     def redo(self):
-        if not self.redo_stack:
-            return
-            
-        current_state = {
-            'items': copy.deepcopy(self.items),
-            'global_ids': copy.deepcopy(self.global_ids)
-        }
-        self.undo_stack.append(current_state)
-        
-        state = self.redo_stack.pop()
-        self.restore_state(state)
+        cmd = self.history.pop_redo()
+        if cmd:
+            self.restore_state(cmd, undo=False)
 
     def on_list_change(self, row: int):
-        # row param corresponds to visual row in QListWidget, which matches 
-        # index in self.items ONLY if not filtered.
-        # Now we use UserRole to get the absolute index in self.items
-        
-        item_widget = self.list.currentItem()
-        if not item_widget:
+        # row is the visual row of the filtered list; the model maps it to the item
+        item = self.list_model.item(row)
+        if item is None:
             self.current_codigo = None
             self.current_label.setText("Sin selección")
             self.fill_id_fields(None)
             return
-            
-        idx = item_widget.data(Qt.UserRole)
-        if idx is None or not isinstance(idx, int) or idx < 0 or idx >= len(self.items):
-             return
 
-        item = self.items[idx]
         self.current_codigo = item.codigo
-        r, c = parse_pos(item.posicion)
+        r, c = item.posicion
         p = self.get_period(item) or "dia"
         # Switch to the item's period tab
         for i in range(self.tabs.count()):
@@ -462,23 +1188,12 @@ class GridEditor(QMainWindow):
                 self.tabs.setCurrentIndex(i)
                 break
         
-        QApplication.processEvents()
-
         tbl = self.tables.get(p)
-        if tbl and not tbl.item(r, c):
-            tbl.setItem(r, c, QTableWidgetItem(""))
-        
         if tbl:
             # Force selection and scroll to item
-            qitem = tbl.item(r, c)
-            if qitem:
-                tbl.setCurrentItem(qitem)
-                tbl.scrollToItem(qitem, QAbstractItemView.PositionAtCenter)
-            else:
-                tbl.setCurrentCell(r, c)
-                tbl.scrollToItem(tbl.item(r, c), QAbstractItemView.PositionAtCenter)
-            
             self.table = tbl
+            self.select_cell(r, c)
+            tbl.scrollTo(tbl.currentIndex(), QAbstractItemView.PositionAtCenter)
             tbl.setFocus()
             
         self.show_cell_details(r, c)
@@ -488,290 +1203,662 @@ class GridEditor(QMainWindow):
     def on_cell_clicked(self, r0: int, c0: int):
         r = r0
         c = c0
-        self.table.setCurrentCell(r, c)
+        self.select_cell(r, c)
         self.show_cell_details(r, c)
         if self.current_codigo and self.move_mode.isChecked():
             self.save_state()
             itm = self.items_by_codigo[self.current_codigo]
             self.move_group_for_item(itm, r, c)
-            self.update_duplicates()
+
+    def items_in_range(self, r0: int, c0: int, r1: int, c1: int, period: str) -> List[CellItem]:
+        # Items of one period inside the rectangle; walks the cells or the index, whichever is smaller
+        if (r1 - r0 + 1) * (c1 - c0 + 1) < len(self.pos_to_item):
+            out = []
+            for r in range(r0, r1 + 1):
+                for c in range(c0, c1 + 1):
+                    d = self.pos_to_item.get(((r, c), period))
+                    if d is not None:
+                        out.append(d)
+            return out
+        return [d for (pos, p), d in self.pos_to_item.items()
+                if p == period and r0 <= pos[0] <= r1 and c0 <= pos[1] <= c1]
 
     def copy_selection(self):
-        r = self.table.currentRow()
-        c = self.table.currentColumn()
-        pos = fmt_pos(r, c)
-        item = self.get_item_at(pos, self.current_period)
-        if item:
-            self.copied_data = {
-                "label": item.label,
-                "codigo": item.codigo,
-                "id_form": item.id_form,
-                "tipo": item.tipo,
-                "deci": item.deci,
-                "valor": item.valor
+        rng = self.selected_range()
+        if rng is None:
+            return
+        r0, c0, r1, c1 = rng
+        cells = {}
+        for d in self.items_in_range(r0, c0, r1, c1, self.current_period):
+            r, c = d.posicion
+            cells[(r - r0, c - c0)] = {
+                "label": d.label,
+                "codigo": d.codigo,
+                "id_form": d.id_form,
+                "tipo": d.tipo,
+                "deci": d.deci,
+                "valor": d.valor
             }
-            self.current_label.setText(f"Copiado: {item.codigo}")
-        else:
+        if not cells:
             self.copied_data = None
             self.current_label.setText("Nada para copiar")
+            return
+        # Empty cells are part of the block too: pasting clears them at the target
+        self.copied_data = {"rows": r1 - r0 + 1, "cols": c1 - c0 + 1, "cells": cells}
+        if len(cells) == 1 and r0 == r1 and c0 == c1:
+            self.current_label.setText(f"Copiado: {cells[(0, 0)]['codigo']}")
+        else:
+            self.current_label.setText(f"Copiadas {len(cells)} celdas ({r1 - r0 + 1}x{c1 - c0 + 1})")
 
     def paste_selection(self):
-        if not hasattr(self, 'copied_data') or not self.copied_data:
+        if not self.copied_data:
             return
-        
-        r = self.table.currentRow()
-        c = self.table.currentColumn()
-        if r < 0 or c < 0:
+        rng = self.selected_range()
+        if rng is None:
             return
-            
-        self.save_state()
-        
-        pos = fmt_pos(r, c)
-        item = self.pos_to_item.get((pos, self.current_period))
-        
-        data = self.copied_data
-        
-        if not item:
-            item = CellItem(
-                id_form=data["id_form"],
-                label=data["label"],
-                codigo=data["codigo"],
-                tipo=data["tipo"],
-                deci=data["deci"],
-                posicion=pos,
-                valor=data["valor"]
-            )
-            self.items.append(item)
-            self.pos_to_item[(pos, self.current_period)] = item
-            if item.codigo:
-                self.items_by_codigo[item.codigo] = item
-        else:
-            item.label = data["label"]
-            item.codigo = data["codigo"]
-            item.id_form = data["id_form"]
-            item.tipo = data["tipo"]
-            item.deci = data["deci"]
-            item.valor = data["valor"]
-            if item.codigo:
-                self.items_by_codigo[item.codigo] = item
-
-        self.place_item(item) # Re-render cell
-        self.show_cell_details(r, c)
-        self.refresh_list()
-        self.update_duplicates()
+        r0, c0, r1, c1 = rng
+        h, w = self.copied_data["rows"], self.copied_data["cols"]
+        cells = self.copied_data["cells"]
+        # A selection larger than the block is tiled with whole copies of it
+        n_r = max(1, (r1 - r0 + 1) // h)
+        n_c = max(1, (c1 - c0 + 1) // w)
+        targets = []
+        for r in range(r0, r0 + h * n_r):
+            for c in range(c0, c0 + w * n_c):
+                targets.append(((r, c), cells.get(((r - r0) % h, (c - c0) % w))))
+        self.write_cells(targets)
+        self.current_label.setText(f"Pegadas {n_r * n_c} copias de {h}x{w}")
+
+    def fill_selection(self, axis: int = 0):
+        # Copies the first row (axis 0) or column (axis 1) of the selection over the rest of it
+        rng = self.selected_range()
+        if rng is None:
+            return
+        r0, c0, r1, c1 = rng
+        if (r1 if axis == 0 else c1) == (r0 if axis == 0 else c0):
+            return
+        p = self.current_period
+        targets = []
+        for r in range(r0, r1 + 1):
+            for c in range(c0, c1 + 1):
+                src = self.pos_to_item.get(((r0, c) if axis == 0 else (r, c0), p))
+                if (r if axis == 0 else c) != (r0 if axis == 0 else c0):
+                    targets.append(((r, c), src.to_json() if src else None))
+        self.write_cells(targets)
 
     def delete_selection(self):
-        r = self.table.currentRow()
-        c = self.table.currentColumn()
-        if r < 0 or c < 0:
+        rng = self.selected_range()
+        if rng is None:
             return
-            
-        pos = fmt_pos(r, c)
-        item = self.get_item_at(pos, self.current_period)
-        
-        if not item:
-            # Clear visual cell just in case
-            self.table.setItem(r, c, QTableWidgetItem(""))
+        doomed = self.items_in_range(*rng, self.current_period)
+        if not doomed:
             return
-            
         self.save_state()
-        
-        # Remove from main list
-        if item in self.items:
-            self.items.remove(item)
-            
-        # Remove from lookup maps
-        if item.codigo and self.items_by_codigo.get(item.codigo) == item:
-            del self.items_by_codigo[item.codigo]
-            
-        self.pos_to_item.pop((pos, self.current_period), None)
-        
-        # Clear UI
-        self.table.setItem(r, c, QTableWidgetItem(""))
+        with self.batched():
+            self.remove_items([(d, self.current_period) for d in doomed])
+        self.show_cell_details(rng[0], rng[1])
+        if hasattr(self, "count_label") and self.count_label:
+            self.count_label.setText(f"{len(self.items)} Items | Cargados")
+
+    def write_cells(self, targets: List[Tuple[Tuple[int, int], Optional[Dict]]]):
+        """Set each (position, fields) of the current period as one undoable step; None clears."""
+        p = self.current_period
+        removed, changed = [], []
+        for pos, data in targets:
+            existing = self.pos_to_item.get((pos, p))
+            if data is None:
+                if existing:
+                    removed.append((existing, p))
+            elif existing is None or any(getattr(existing, f) != data[f] for f in ("label", "codigo", "id_form", "tipo", "deci", "valor")):
+                changed.append((pos, existing, data))
+        if not removed and not changed:
+            return
+        self.save_state()
+        created = []
+        with self.batched():
+            if removed:
+                self.remove_items(removed)
+            for pos, existing, data in changed:
+                if existing is None:
+                    new = CellItem(
+                        id_form=data["id_form"],
+                        label=data["label"],
+                        codigo=data["codigo"],
+                        tipo=data["tipo"],
+                        deci=data["deci"],
+                        posicion=intern_pos(*pos),
+                        valor=data["valor"]
+                    )
+                    self.add_item(new, p)
+                    created.append(new)
+                else:
+                    for field in ("label", "codigo", "id_form", "tipo", "deci", "valor"):
+                        self.set_item_field(existing, p, field, data[field])
+            # New cells of this sheet's form are mirrored like typed ones
+            own_id = self.global_ids.get(p)
+            if own_id:
+                self.propagate_items([d for d in created if d.id_form == own_id], p)
+        r, c = targets[0][0]
         self.show_cell_details(r, c)
-        self.refresh_list()
-        self.update_duplicates()
-        
         if hasattr(self, "count_label") and self.count_label:
             self.count_label.setText(f"{len(self.items)} Items | Cargados")
 
+    @profiled()
     def update_duplicates(self):
-        counts = {}
-        # Count normalized codes from source data
-        for d in self.items:
-            if d.codigo:
-                c_norm = d.codigo.strip().upper()
-                if c_norm:
-                    counts[c_norm] = counts.get(c_norm, 0) + 1
-        
-        # Use the maintained map directly
-        item_map = self.pos_to_item
-            
-        # Update ALL visual items in all tables based on the code they carry
-        # IMPROVED: Look up the actual item to ensure we use the latest code
-        # and clear "ghost" items that shouldn't be there.
-        for period, tbl in self.tables.items():
-            for r in range(tbl.rowCount()):
-                for c in range(tbl.columnCount()):
-                    itm = tbl.item(r, c)
-                    
-                    # Find the actual item for this cell and period
-                    pos = fmt_pos(r, c)
-                    real_item = item_map.get((pos, period))
-                    
-                    if real_item:
-                        # Ensure visual item exists
-                        if not itm:
-                            itm = QTableWidgetItem(real_item.label)
-                            tbl.setItem(r, c, itm)
-                        
-                        # Update data and visual state
-                        code_val = real_item.codigo
-                        itm.setData(Qt.UserRole, code_val)
-                        
-                        # Sync label if needed (optional but good for consistency)
-                        if itm.text() != real_item.label:
-                            itm.setText(real_item.label)
-                            
-                        c_norm = code_val.strip().upper() if code_val else ""
-                        
-                        if c_norm and counts.get(c_norm, 0) > 1:
-                            itm.setBackground(QColor("#FF0000")) # Strong red
-                            itm.setForeground(QColor("white"))
-                            itm.setToolTip(f"Código duplicado: {code_val}")
-                        else:
-                            itm.setBackground(QColor("#1E1E2E")) # Restore default
-                            itm.setForeground(QColor("white"))
-                            itm.setToolTip("")
-                    else:
-                        # If no item belongs here, but we have a visual item, it's a ghost. Clear it.
-                        if itm and itm.text():
-                            tbl.setItem(r, c, QTableWidgetItem(""))
+        # Full recount, only needed when the whole item list is replaced
+        self.dups.rebuild(self.items)
+        for model in self.models.values():
+            model.refresh_all()
+
+    def repaint_items(self, items: List[CellItem]):
+        for d in items:
+            r, c = d.posicion
+            self.refresh_cell(self.get_period(d) or "dia", r, c)
+
+    def track_duplicates(self, d: CellItem):
+        self.repaint_items(self.dups.add(d))
+
+    def untrack_duplicates(self, d: CellItem):
+        self.repaint_items(self.dups.remove(d))
+
+    def retrack_duplicates(self, d: CellItem):
+        self.repaint_items(self.dups.update(d))
+
+    def is_duplicate(self, d: CellItem) -> bool:
+        return self.dups.is_duplicate(d)
 
     def on_row_height_change(self, val: int):
         for tbl in self.tables.values():
-            for r in range(tbl.rowCount()):
-                tbl.setRowHeight(r, val)
+            tbl.verticalHeader().setDefaultSectionSize(val)
 
+    @profiled()
     def on_search_changed(self, text: str):
-        text = text.lower().strip()
-        self.list.clear()
-        
-        # Filter list items
-        for idx, d in enumerate(self.items):
-            # Only show items belonging to the current active period
-            p = self.get_period(d) or "dia"
-            if p != self.current_period:
-                continue
-                
-            # Match against code, label, or value
-            full_str = f"{d.codigo} | {d.label} | {d.valor}"
-            if not text or text in full_str.lower():
-                disp = f"{d.codigo} | {d.label}"
-                if d.valor:
-                    disp += f" | {d.valor}"
-                item = QListWidgetItem(disp)
-                item.setData(Qt.UserRole, idx)
-                self.list.addItem(item)
+        # Only items of the active period, matched against code, label or value
+        self.search_timer.stop()
+        self.list_query = text.lower().strip()
+        self.list_model.set_items(self.search.search(self.current_period, self.list_query))
+
+    def sync_list_item(self, d: CellItem):
+        # Keeps one sidebar row in step with an edit instead of requerying
+        if self.batch_depth:
+            self.pending_list[id(d)] = d
+            return
+        show = self.search.matches(d, self.current_period, self.list_query)
+        row = self.list_model.row_of(d)
+        if not show and row >= 0 and self.list.currentIndex().row() == row:
+            # Leave the list unselected rather than jumping to a neighbour
+            self.list.selectionModel().clearCurrentIndex()
+        self.list_model.sync(d, show)
     
     def on_search_return(self):
         text = self.search_entry.text().lower().strip()
         if not text:
             return
+        if self.search_timer.isActive():
+            self.on_search_changed(self.search_entry.text())
             
         # Find first match in items that is NOT the current selection if possible,
         # or just the first match.
         # For simplicity, let's find the first match in the filtered list.
         
-        if self.list.count() > 0:
+        if self.list_model.rowCount() > 0:
             # Select first item in the list, which triggers on_list_change -> selecting cell
-            self.list.setCurrentRow(0)
+            self.list.setCurrentIndex(self.list_model.index(0))
             self.list.setFocus()
 
+    @profiled()
     def on_load_json(self):
         path, _ = QFileDialog.getOpenFileName(self, "Abrir JSON", "", "Archivos (*.json *.txt);;Todos (*.*)")
         if not path:
             return
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                raw = f.read()
-            try:
-                data = json.loads(raw)
-            except Exception:
-                lines = [json.loads(l) for l in raw.splitlines() if l.strip()]
-                data = lines
-        except Exception as e:
-            QMessageBox.critical(self, "Error", str(e))
+        self.open_file(path)
+
+    def open_file(self, path: str, recovery: Optional[tuple] = None):
+        # recovery is (journal path, header, entries) to replay once the file is loaded
+        for i, doc in enumerate(self.documents):
+            if os.path.abspath(doc.path) == os.path.abspath(path):
+                # Already open: its tab holds any unsaved edits
+                self.doc_tabs.setCurrentIndex(i)
+                return
+        def parse(worker, path):
+            with PROFILER.span("load.parse"):
+                # Lazy: rows and untouched subtrees stay in the file, read through the mapped document
+                result = open_closing_file(path, worker.report, lambda: worker.cancelled, lazy=True)
+                if result is None:
+                    return None
+                # An empty file cannot be mapped, and has nothing to read back anyway
+                return (*result, LazyDocument(path) if os.path.getsize(path) else None)
+        self.run_in_background("Cargando JSON...", parse, lambda res: self.on_file_parsed(res, path, recovery), path, cancellable=True)
+
+    @profiled("load.on_file_parsed")
+    def on_file_parsed(self, result, path: str, recovery: Optional[tuple] = None):
+        if result is None:
+            self.current_label.setText("Carga cancelada")
             return
-        def rows_from_datosAG(x):
-            if isinstance(x, dict) and isinstance(x.get("datosAG"), list):
-                out = []
-                for group in x["datosAG"]:
-                    if isinstance(group, list):
-                        out.extend([d for d in group if isinstance(d, dict)])
-                return out
-            return None
-        self.root_data = data
-        rows = rows_from_datosAG(data)
-        if rows is None:
-            def collect_entries(x):
-                out = []
-                def rec(v):
-                    if isinstance(v, dict):
-                        if all(k in v for k in ("codigo", "posicion", "label")):
-                            out.append(v)
-                        else:
-                            for vv in v.values():
-                                rec(vv)
-                    elif isinstance(v, list):
-                        for e in v:
-                            rec(e)
-                rec(x)
-                return out
-            rows = collect_entries(data)
-        items: List[CellItem] = []
-        for d in rows:
-            try:
-                items.append(CellItem(
-                    id_form=int(d.get("id_form", 0)),
-                    label=str(d.get("label", "")),
-                    codigo=str(d.get("codigo", "")),
-                    tipo=int(d.get("tipo", 0)),
-                    deci=int(d.get("deci", 0)),
-                    posicion=str(d.get("posicion", "1:1")),
-                    valor=str(d.get("valor", "")),
-                ))
-            except Exception:
-                pass
-        self.items = items
-        self.items_by_codigo = {d.codigo: d for d in self.items}
-        
+        self.begin_document(path)
+        self.root_data, items, paths, self.source_jsonl, doc = result
         self.extract_global_ids()
         
-        # Rebuild pos_to_item with (pos, period) keys to support overlapping positions
-        self.pos_to_item = {}
-        for d in self.items:
-            p = self.get_period(d) or "dia"
-            self.pos_to_item[(d.posicion, p)] = d
-            
-        self.build_groups()
+        if recovery:
+            # Same ids and filter as the session being recovered, without asking
+            header = recovery[1]
+            self.global_ids = {k: header["ids"].get(k) for k in self.global_ids}
+            filtered = header["filtered"]
+        else:
+            # Check if any global IDs are missing OR just prompt always as requested
+            # User requested: "al inicio quiero que pregunte por el id form... para que se filtre"
+            # So we force prompt here.
+            filtered = self.ask_global_ids()
+        if filtered:
+            self.apply_global_ids_to_root()
+        root = self.root_data
+        @profiled("load.index")
+        def index(worker, items, paths):
+            periods = PeriodIndex(self.periods.classify)
+            periods.rebuild(items)
+            sources = SourceIndex()
+            sources.build(root, items, paths, [periods.bucket_of(d) for d in items], doc)
+            if filtered:
+                kept = self.filter_by_global_ids(items, sources)
+                if len(kept) != len(items):
+                    kept_ids = {id(d) for d in kept}
+                    for d in items:
+                        if id(d) not in kept_ids:
+                            periods.remove(d)
+                items = kept
+            return items, sources, self.index_items(items, periods)
+        self.run_in_background("Indexando...", index, lambda res: self.on_items_indexed(res, path, filtered, recovery), items, paths)
+
+    @profiled("load.on_items_indexed")
+    def on_items_indexed(self, result, path: str, filtered: bool, recovery: Optional[tuple] = None):
+        items, sources, (by_codigo, pos_to_item, groups, dups, periods, search) = result
+        if self.sources.doc is not None and self.sources.doc is not sources.doc:
+            self.sources.doc.close()
+        self.items = items
+        self.sources = sources
+        self.items_by_codigo = by_codigo
+        self.pos_to_item = pos_to_item
+        self.groups = groups
+        self.dups = dups
+        self.periods = periods
+        self.search = search
+        if filtered and not recovery:
+            QMessageBox.information(self, "Info", f"Datos filtrados. {len(self.items)} items retenidos.")
         
-        # Check if any global IDs are missing OR just prompt always as requested
-        # User requested: "al inicio quiero que pregunte por el id form... para que se filtre"
-        # So we force prompt here.
-        self.prompt_global_ids(force_filter=True)
-            
         self.refresh_list()
         self.render_from_items()
-        self.undo_stack.clear()
-        self.redo_stack.clear()
+        self.history.clear()
+        self.saved_command = None
+        self.diff = None
+        self.update_diff_view()
         self.current_label.setText(f"Cargados: {len(self.items)} items")
         if hasattr(self, "count_label") and self.count_label:
             self.count_label.setText(f"{len(self.items)} Items | Cargados")
+        if recovery:
+            self.replay_journal(*recovery)
+        else:
+            self.start_journal(path, filtered, self.items)
         if not self.items:
             QMessageBox.information(self, "Aviso", "No se encontraron items válidos en el JSON")
 
-    def prompt_global_ids(self, force_filter=False):
+    def start_journal(self, source: str, filtered: bool, items: List[CellItem]):
+        # items in the order reloading source yields them
+        if self.journal is not None:
+            self.journal.discard()
+        self.journal = EditJournal(journal_path(source))
+        self.journal.on_pending = self.journal_timer.start
+        self.journal.start(source, self.global_ids, filtered, items)
+        self.history.journal = self.journal
+
+    def flush_journal(self):
+        if self.journal is not None:
+            self.journal.flush()
+
+    def replay_journal(self, path: str, header: Dict, entries: List[list]):
+        if header["count"] != len(self.items) or header["fingerprint"] != items_fingerprint(self.items):
+            QMessageBox.warning(self, "Recuperación", "El archivo cambió desde la sesión anterior; los cambios sin guardar no se pueden recuperar.")
+            self.start_journal(header["source"], header["filtered"], self.items)
+            return
+        journal = EditJournal(path)
+        journal.register(self.items)
+        # Replayed commands go straight into the history; the journal already holds them
+        self.history.journal = None
+        cmd: Optional[EditCommand] = None
+        done = 0
+        try:
+            for entry in entries:
+                kind = entry[0]
+                if kind in ("begin", "undo", "redo", "config"):
+                    if cmd is not None and cmd.ops:
+                        self.history.push(cmd)
+                        done += 1
+                    cmd = EditCommand() if kind == "begin" else None
+                if kind == "undo":
+                    self.undo()
+                elif kind == "redo":
+                    self.redo()
+                elif kind == "config":
+                    self.global_ids = dict(entry[1])
+                    self.apply_global_ids_to_root()
+                    self.reclassify_periods()
+                elif kind != "begin":
+                    op = ("clear", self.items, self.pos_to_item) if kind == "clear" else journal.decode(entry)
+                    cmd.record(op)
+                    self.apply_op(op, False)
+            if cmd is not None and cmd.ops:
+                self.history.push(cmd)
+                done += 1
+        except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+            QMessageBox.warning(self, "Recuperación", f"El diario de cambios está dañado; se recuperaron {done} ediciones. Guarde el archivo.")
+            self.start_journal(header["source"], header["filtered"], self.items)
+            return
+        self.journal = journal
+        journal.on_pending = self.journal_timer.start
+        journal.resume()
+        self.history.journal = journal
+        if hasattr(self, "count_label") and self.count_label:
+            self.count_label.setText(f"{len(self.items)} Items | Cargados")
+        self.current_label.setText(f"Sesión recuperada: {done} ediciones")
+
+    def check_recovery(self):
+        """Offer to replay the journal a crashed session left behind."""
+        try:
+            names = [n for n in os.listdir(journal_dir()) if n.endswith(".journal")]
+        except OSError:
+            return
+        found = []
+        for name in names:
+            path = os.path.join(journal_dir(), name)
+            header, entries = read_journal(path)
+            if header is not None and entries:
+                found.append((os.path.getmtime(path), path, header, entries))
+            elif header is not None:
+                # Opened and never edited: nothing to recover
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        if not found:
+            return
+        _, path, header, entries = max(found, key=lambda f: f[0])
+        edits = sum(1 for e in entries if e[0] == "begin")
+        answer = QMessageBox.question(self, "Recuperar sesión", f"Hay {edits} ediciones sin guardar de una sesión anterior en:\n{header['source']}\n\n¿Recuperarlas?")
+        if answer != QMessageBox.Yes:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return
+        if not os.path.exists(header["source"]):
+            QMessageBox.warning(self, "Recuperación", "El archivo de la sesión anterior ya no existe.")
+            return
+        self.open_file(header["source"], (path, header, entries))
+
+    def closeEvent(self, event):
+        # A clean exit leaves nothing to recover
+        if self.journal is not None:
+            self.journal.discard()
+            self.journal = None
+        for doc in self.documents:
+            if doc is not self.active_doc:
+                self.discard_document(doc)
+        super().closeEvent(event)
+
+    def last_command(self) -> Optional[EditCommand]:
+        return next((cmd for cmd in reversed(self.history.undo_stack) if cmd.ops), None)
+
+    def document_modified(self) -> bool:
+        return self.last_command() is not self.saved_command
+
+    def update_document_tab(self, doc: OpenDocument):
+        i = self.documents.index(doc)
+        self.doc_tabs.setTabText(i, os.path.basename(doc.path))
+        self.doc_tabs.setTabToolTip(i, doc.path)
+        if doc is self.active_doc:
+            self.setWindowTitle(f"Cierres Maker - {os.path.basename(doc.path)}")
+
+    def begin_document(self, path: str):
+        """Give a file being loaded its own tab; an empty, unmodified tab is reused."""
+        doc = self.active_doc
+        if doc is None or self.items or self.document_modified():
+            if doc is not None:
+                self.stash_document()
+            doc = OpenDocument(path)
+            self.documents.append(doc)
+            self.doc_tabs.blockSignals(True)
+            self.doc_tabs.setCurrentIndex(self.doc_tabs.addTab(""))
+            self.doc_tabs.blockSignals(False)
+            self.doc_tabs.show()
+            self.active_doc = None
+            self.reset_document()
+            self.active_doc = doc
+            self.doc_uses += 1
+            doc.used = self.doc_uses
+            self.evict_documents()
+        doc.path = path
+        self.update_document_tab(doc)
+
+    def stash_document(self):
+        # The active document's attributes move into its OpenDocument
+        if self.journal is not None:
+            self.journal.flush()
+        doc = self.active_doc
+        doc.modified = self.document_modified()
+        doc.state = {f: getattr(self, f) for f in self.DOC_FIELDS}
+
+    def reset_document(self):
+        periods = PeriodIndex(self.periods.classify)
+        self.root_data = None
+        self.source_jsonl = False
+        self.sources = SourceIndex()
+        self.items = []
+        self.items_by_codigo = {}
+        self.pos_to_item = {}
+        self.periods = periods
+        self.groups = GroupIndex(periods)
+        self.dups = DuplicateIndex()
+        self.search = SearchIndex(periods)
+        self.global_ids = {p: None for p in PERIODS}
+        self.history = EditHistory()
+        self.journal = None
+        self.saved_command = None
+        self.current_codigo = None
+        self.diff = None
+        self.show_document()
+
+    def show_document(self):
+        self.render_from_items()
+        self.update_diff_view()
+        self.refresh_list()
+        self.fill_id_fields(None)
+        self.current_label.setText(f"Cargados: {len(self.items)} items")
+        if hasattr(self, "count_label") and self.count_label:
+            self.count_label.setText(f"{len(self.items)} Items | Cargados")
+        if self.active_doc is None:
+            self.setWindowTitle("Cierres Maker")
+
+    def evict_documents(self):
+        # Least recently used first; the active document has no stashed state
+        resident = sorted((d for d in self.documents if d.state is not None), key=lambda d: d.used, reverse=True)
+        for doc in resident[max(0, self.RESIDENT_DOCUMENTS - 1):]:
+            self.evict_document(doc)
+
+    def evict_document(self, doc: OpenDocument):
+        state = doc.state
+        if state["journal"] is not None:
+            state["journal"].suspend()
+            doc.journal_path = state["journal"].path
+        doc.source = state["sources"].doc
+        doc.blob = pack_state({f: v for f, v in state.items() if f not in self.DOC_INDEXES})
+        doc.state = None
+
+    def on_document_tab_changed(self, idx: int):
+        if 0 <= idx < len(self.documents):
+            self.activate_document(self.documents[idx])
+
+    def activate_document(self, doc: OpenDocument):
+        if doc is self.active_doc:
+            return
+        if doc.state is not None:
+            self.enter_document(doc, doc.state)
+            return
+        # The tab follows once the document is back in the editor
+        if self.active_doc is not None:
+            self.doc_tabs.blockSignals(True)
+            self.doc_tabs.setCurrentIndex(self.documents.index(self.active_doc))
+            self.doc_tabs.blockSignals(False)
+        def unpack(worker, blob):
+            state = unpack_state(blob)
+            # Indexed as on load; classify is pointed at the editor's ids when the document enters
+            ids, items = state["global_ids"], state["items"]
+            periods = PeriodIndex(lambda d: classify_period(d, ids))
+            periods.rebuild(items)
+            groups = GroupIndex(periods)
+            groups.rebuild(items)
+            dups = DuplicateIndex()
+            dups.rebuild(items)
+            search = SearchIndex(periods)
+            search.rebuild(items)
+            state.update(periods=periods, groups=groups, dups=dups, search=search)
+            return state
+        self.run_in_background("Abriendo documento...", unpack, lambda state: self.enter_document(doc, state), doc.blob)
+
+    def enter_document(self, doc: OpenDocument, state: Dict):
+        if self.active_doc is not None:
+            self.stash_document()
+        if doc.blob is not None:
+            state["periods"].classify = self.periods.classify
+            state["sources"].doc = doc.source
+            if state["journal"] is not None:
+                state["journal"].resume()
+            doc.blob = doc.source = None
+        doc.state = None
+        for f, v in state.items():
+            setattr(self, f, v)
+        if self.journal is not None:
+            self.journal.on_pending = self.journal_timer.start
+        self.active_doc = doc
+        self.doc_uses += 1
+        doc.used = self.doc_uses
+        self.doc_tabs.blockSignals(True)
+        self.doc_tabs.setCurrentIndex(self.documents.index(doc))
+        self.doc_tabs.blockSignals(False)
+        self.show_document()
+        self.update_document_tab(doc)
+        self.evict_documents()
+
+    def discard_document(self, doc: OpenDocument):
+        # Journal and mapped file of a document that is not in the editor
+        if doc.state is not None:
+            if doc.state["journal"] is not None:
+                doc.state["journal"].discard()
+            source = doc.state["sources"].doc
+        else:
+            if doc.journal_path:
+                try:
+                    os.remove(doc.journal_path)
+                except OSError:
+                    pass
+            source = doc.source
+        if source is not None:
+            source.close()
+        doc.state = doc.blob = doc.source = None
+
+    def close_document(self, idx: int):
+        doc = self.documents[idx]
+        active = doc is self.active_doc
+        if active:
+            doc.modified = self.document_modified()
+        if doc.modified:
+            answer = QMessageBox.question(self, "Cerrar documento", f"{os.path.basename(doc.path)} tiene cambios sin guardar.\n\n¿Cerrarlo de todos modos?")
+            if answer != QMessageBox.Yes:
+                return
+        if active:
+            self.stash_document()
+            self.active_doc = None
+        self.discard_document(doc)
+        del self.documents[idx]
+        self.doc_tabs.blockSignals(True)
+        self.doc_tabs.removeTab(idx)
+        self.doc_tabs.blockSignals(False)
+        if not active:
+            return
+        self.reset_document()
+        if self.documents:
+            self.activate_document(max(self.documents, key=lambda d: d.used))
+        else:
+            self.doc_tabs.hide()
+
+    def index_items(self, items: List[CellItem], periods: Optional[PeriodIndex] = None):
+        # Builds fresh indexes without touching self, so it can run in a worker
+        if periods is None:
+            periods = PeriodIndex(self.periods.classify)
+            periods.rebuild(items)
+        by_codigo = {d.codigo: d for d in items}
+        # (pos, period) keys to support overlapping positions
+        pos_to_item = {}
+        for d in items:
+            pos_to_item[(d.posicion, periods.bucket_of(d))] = d
+        dups = DuplicateIndex()
+        dups.rebuild(items)
+        search = SearchIndex(periods)
+        search.rebuild(items)
+        groups = GroupIndex(periods)
+        groups.rebuild(items)
+        return by_codigo, pos_to_item, groups, dups, periods, search
+
+    def filter_by_global_ids(self, items: List[CellItem], sources: Optional[SourceIndex] = None) -> List[CellItem]:
+        return filter_by_global_ids(items, self.global_ids, sources)
+
+    def run_in_background(self, text: str, fn, on_done, *args, cancellable: bool = False):
+        """Run fn(worker, *args) off the GUI thread, then on_done(result) here.
+
+        Cancelar is only offered when fn polls worker.cancelled (cancellable);
+        it then returns None and on_done has to expect that.
+        """
+        self.busy = True
+        self.centralWidget().setEnabled(False)
+        for sc in self.shortcuts:
+            sc.setEnabled(False)
+        self.progress.setRange(0, 0) # Busy indicator until progress arrives
+        self.progress.show()
+        self.cancel_btn.setVisible(cancellable)
+        self.statusBar().showMessage(text)
+        worker = Worker(fn, *args)
+        worker.signals.progress.connect(self.update_progress)
+        worker.signals.finished.connect(lambda result: self.finish_background(on_done, result))
+        worker.signals.failed.connect(self.on_background_failed)
+        self.worker = worker
+        self.pool.start(worker)
+
+    def update_progress(self, done: int, total: int):
+        if total:
+            self.progress.setRange(0, 1000)
+            self.progress.setValue(int(1000 * done / total))
+
+    def end_progress(self):
+        self.worker = None
+        self.busy = False
+        self.progress.hide()
+        self.cancel_btn.hide()
+        self.statusBar().clearMessage()
+        self.centralWidget().setEnabled(True)
+        for sc in self.shortcuts:
+            sc.setEnabled(True)
+
+    def finish_background(self, on_done, result):
+        self.end_progress()
+        on_done(result)
+
+    def on_background_failed(self, msg: str):
+        self.end_progress()
+        QMessageBox.critical(self, "Error", msg)
+
+    def on_cancel_progress(self):
+        if self.worker:
+            self.worker.cancelled = True
+
+    def ask_global_ids(self) -> bool:
         dlg = QDialog(self)
         dlg.setWindowTitle("Configurar IDs Globales")
         layout = QVBoxLayout(dlg)
@@ -794,190 +1881,123 @@ class GridEditor(QMainWindow):
         btns.rejected.connect(dlg.reject)
         layout.addWidget(btns)
         
-        if dlg.exec() == QDialog.Accepted:
-            for k, inp in inputs.items():
-                txt = inp.text().strip()
-                if txt.isdigit():
-                    self.global_ids[k] = int(txt)
-                else:
-                    self.global_ids[k] = None
-            
-            if force_filter:
-                # Filter items to only keep those matching the configured IDs
-                filtered_items = []
-                # Collect valid IDs
-                valid_ids = {v for v in self.global_ids.values() if v is not None}
-                
-                for d in self.items:
-                    # If item's ID matches one of the valid global IDs, keep it.
-                    # Or if the item's period is detected via other means, check if that period is allowed.
-                    
-                    # Strict filtering based on ID match as requested: "filtre cada valor... para que solo salgan los datos de este tipo"
-                    if d.id_form in valid_ids:
-                        filtered_items.append(d)
-                
-                self.items = filtered_items
-                self.items_by_codigo = {d.codigo: d for d in self.items}
-                
-                self.pos_to_item = {}
-                for d in self.items:
-                    p = self.get_period(d) or "dia"
-                    self.pos_to_item[(d.posicion, p)] = d
-                    
-                self.build_groups()
-                QMessageBox.information(self, "Info", f"Datos filtrados. {len(self.items)} items retenidos.")
+        if dlg.exec() != QDialog.Accepted:
+            return False
+        for k, inp in inputs.items():
+            txt = inp.text().strip()
+            if txt.isdigit():
+                self.global_ids[k] = int(txt)
+            else:
+                self.global_ids[k] = None
+        return True
 
-            self.apply_global_ids_to_root()
+    def prompt_global_ids(self, force_filter=False):
+        if not self.ask_global_ids():
+            return
+        if force_filter:
+            # Filter items to only keep those matching the configured IDs
+            self.items = self.filter_by_global_ids(self.items, self.sources)
+            self.items_by_codigo, self.pos_to_item, self.groups, self.dups, self.periods, self.search = self.index_items(self.items)
+            QMessageBox.information(self, "Info", f"Datos filtrados. {len(self.items)} items retenidos.")
+            self.refresh_list()
+        else:
+            # Periods can follow the ids
+            self.reclassify_periods()
+        self.apply_global_ids_to_root()
+        if self.journal is not None:
+            self.journal.config(self.global_ids)
 
+    @profiled()
     def on_save_json(self):
         if not self.items:
             return
         path, _ = QFileDialog.getSaveFileName(self, "Guardar JSON", "", "JSON (*.json)")
         if not path:
             return
-        try:
-            data = [d.__dict__ for d in self.items]
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            QMessageBox.critical(self, "Error", str(e))
-
+        jsonl = False
+        source = None
+        doc = self.sources.doc
+        if self.keep_structure.isChecked() and self.sources.can_patch():
+            # Patch the loaded document; the editor stays disabled while it is written
+            data = self.update_root_with_items_and_ids()
+            jsonl = self.source_jsonl
+            # Untouched parts are copied from the original bytes
+            source = doc
+            saved = self.sources.ordered_items(data)
+        else:
+            # Snapshot on the GUI thread; the worker only serializes and writes
+            data = [d.to_json() for d in self.items]
+            saved = list(self.items)
+            if doc is not None and doc.buf is not None and os.path.exists(path) and os.path.samefile(path, doc.path):
+                # The flat list replaces the source, so root_data must stop reading from it
+                doc.detach(self.root_data)
+        def write(worker, path, data, jsonl, source):
+            with PROFILER.span("save.write"):
+                write_closing_file(path, data, jsonl, source)
+        self.run_in_background("Guardando JSON...", write, lambda _: self.on_saved(path, saved), path, data, jsonl, source)
+
+    def on_saved(self, path: str, items: List[CellItem]):
+        # The saved file becomes the base the journal replays onto
+        self.start_journal(path, False, items)
+        self.saved_command = self.last_command()
+        if self.active_doc is not None:
+            self.active_doc.path = path
+            self.update_document_tab(self.active_doc)
+
+    @profiled()
     def refresh_list(self):
         if hasattr(self, "search_entry"):
             self.on_search_changed(self.search_entry.text())
         else:
             self.on_search_changed("")
 
+    @profiled()
     def render_from_items(self):
         # Ensure tabs exist for current items
         self.setup_tabs_from_items()
-        # Calculate global grid size
-        if not self.items:
-            for tbl in self.tables.values():
-                tbl.setRowCount(0)
-                tbl.setColumnCount(0)
-                tbl.clearContents()
-            return
-        max_r = 0
-        max_c = 0
-        for d in self.items:
-            r, c = parse_pos(d.posicion)
-            max_r = max(max_r, r)
-            max_c = max(max_c, c)
-        # Prepare each table
-        for period, tbl in self.tables.items():
-            tbl.setRowCount(max_r + 1)
-            tbl.setColumnCount(max_c + 1)
-            tbl.clearContents()
-            for r in range(tbl.rowCount()):
-                tbl.setRowHeight(r, 24)
-            for c in range(tbl.columnCount()):
-                tbl.setColumnWidth(c, 120)
-            tbl.setHorizontalHeaderLabels([col_name(i) for i in range(tbl.columnCount())])
-            tbl.setVerticalHeaderLabels([str(i + 1) for i in range(tbl.rowCount())])
-        # Place items only into their period's table
-        self.updating = True
-        for d in self.items:
-            self.place_item(d)
-        self.update_duplicates()
-        self.updating = False
-
-    def place_item(self, d: CellItem):
-        p = self.get_period(d) or "dia"
-        tbl = self.tables.get(p)
-        if not tbl:
-            return
-        r, c = parse_pos(d.posicion)
-        item = QTableWidgetItem(d.label)
-        item.setData(Qt.UserRole, d.codigo)
-        tbl.setItem(r, c, item)
+        # Global grid size, kept by the group index
+        max_r = self.groups.max_r
+        max_c = self.groups.max_c
+        # Size each model; cells are looked up lazily when painted
+        for period, model in self.models.items():
+            cur = self.tables[period].currentIndex()
+            model.reset_extent(max_r + 1, max_c + 1)
+            if cur.isValid() and cur.row() <= max_r and cur.column() <= max_c:
+                self.tables[period].setCurrentIndex(model.index(cur.row(), cur.column()))
 
     def get_period(self, d: CellItem) -> Optional[str]:
-        code = d.codigo.strip().upper()
-        if len(code) >= 2:
-            prefix = code[:2]
-            m = {"CD": "dia", "CS": "semana", "CM": "mes", "CA": "anio"}
-            if prefix in m:
-                return m[prefix]
-        for k in ["dia", "semana", "mes", "anio"]:
-            val = self.global_ids.get(k)
-            if val is not None and d.id_form == val:
-                return k
-        lbl = d.label.upper()
-        for k in ["DIA", "SEMANA", "MES", "AÑO", "ANIO"]:
-            if k in lbl:
-                return {"DIA": "dia", "SEMANA": "semana", "MES": "mes", "AÑO": "anio", "ANIO": "anio"}[k]
-        return None
+        return self.periods.get(d)
 
     def normalize_label(self, lbl: str) -> str:
-        u = lbl.upper().strip()
-        for k in [" DIA", " SEMANA", " MES", " AÑO", " ANIO"]:
-            if u.endswith(k):
-                u = u[: -len(k)]
-                break
-        return u
-
-    def build_groups(self):
-        self.groups = {}
-        for d in self.items:
-            p = self.get_period(d)
-            base = self.normalize_label(d.label)
-            if not p:
-                p = "dia"
-            if base not in self.groups:
-                self.groups[base] = {}
-            if p not in self.groups[base]:
-                self.groups[base][p] = []
-            self.groups[base][p].append(d)
+        return normalize_label(lbl)
 
+    @profiled()
     def move_group_for_item(self, pivot: CellItem, new_r: int, new_c: int):
-        base = self.normalize_label(pivot.label)
-        grp = self.groups.get(base, {})
-        pr_r, pr_c = parse_pos(pivot.posicion)
+        grp = self.groups.group_of(pivot)
+        pr_r, pr_c = pivot.posicion
         deltas: Dict[str, int] = {}
         
         for k, items_list in grp.items():
             if items_list:
                 # Use the first item to determine the current column of this period block
-                r, c = parse_pos(items_list[0].posicion)
+                r, c = items_list[0].posicion
                 deltas[k] = c - pr_c
                 
-        max_c = 0
-        max_r = 0
-        # Determine current global grid size across items
-        for d in self.items:
-            rr, cc = parse_pos(d.posicion)
-            max_r = max(max_r, rr)
-            max_c = max(max_c, cc)
+        # Current global grid size, kept by the group index
+        max_r = max(self.groups.max_r, 0)
+        max_c = max(self.groups.max_c, 0)
         max_c = max(max_c, (new_c + (max(deltas.values()) if deltas else 0)) + 1)
         max_r = max(max_r, new_r + 1)
         # Apply to all tables
-        for tbl in self.tables.values():
-            tbl.setRowCount(max_r)
-            tbl.setColumnCount(max_c)
+        self.ensure_extent(max_r, max_c)
         
         for k, items_list in grp.items():
-            # Clear old positions first
-            for it in items_list:
-                old_r, old_c = parse_pos(it.posicion)
-                if old_r >= 0 and old_c >= 0:
-                    p_it = self.get_period(it) or "dia"
-                    tbl_it = self.tables.get(p_it)
-                    if tbl_it:
-                        tbl_it.setItem(old_r, old_c, QTableWidgetItem(""))
-            
             # Update to new positions
             delta = deltas.get(k, 0)
             target_c = new_c + delta
             
             for it in items_list:
-                it.posicion = fmt_pos(new_r, target_c)
-                self.place_item(it)
-                
-        self.pos_to_item = {}
-        for d in self.items:
-            p = self.get_period(d) or "dia"
-            self.pos_to_item[(d.posicion, p)] = d
+                self.set_item_field(it, k, "posicion", intern_pos(new_r, target_c))
 
     def fill_id_fields(self, item: Optional[CellItem]):
         if not item:
@@ -986,8 +2006,7 @@ class GridEditor(QMainWindow):
             self.id_form_mes.setText("")
             self.id_form_anio.setText("")
             return
-        base = self.normalize_label(item.label)
-        grp = self.groups.get(base, {})
+        grp = self.groups.group_of(item)
         
         def get_id(k):
             # Return ID from the first item in the list, or global fallback
@@ -1010,8 +2029,7 @@ class GridEditor(QMainWindow):
             return
         self.save_state()
         item = self.items_by_codigo[self.current_codigo]
-        base = self.normalize_label(item.label)
-        grp = self.groups.get(base, {})
+        grp = self.groups.group_of(item)
         def to_int(s: str) -> Optional[int]:
             s = s.strip()
             if not s:
@@ -1026,105 +2044,148 @@ class GridEditor(QMainWindow):
         v_a = to_int(self.id_form_anio.text())
         
         if grp.get("dia") and v_d is not None:
-            for it in grp["dia"]: it.id_form = v_d
+            for it in list(grp["dia"]): self.set_item_field(it, "dia", "id_form", v_d)
         if grp.get("semana") and v_s is not None:
-            for it in grp["semana"]: it.id_form = v_s
+            for it in list(grp["semana"]): self.set_item_field(it, "semana", "id_form", v_s)
         if grp.get("mes") and v_m is not None:
-            for it in grp["mes"]: it.id_form = v_m
+            for it in list(grp["mes"]): self.set_item_field(it, "mes", "id_form", v_m)
         if grp.get("anio") and v_a is not None:
-            for it in grp["anio"]: it.id_form = v_a
+            for it in list(grp["anio"]): self.set_item_field(it, "anio", "id_form", v_a)
             
-        self.global_ids = {
+        self.set_global_ids({
             "dia": v_d if v_d is not None else self.global_ids.get("dia"),
             "semana": v_s if v_s is not None else self.global_ids.get("semana"),
             "mes": v_m if v_m is not None else self.global_ids.get("mes"),
             "anio": v_a if v_a is not None else self.global_ids.get("anio"),
-        }
-        self.apply_global_ids_to_root()
+        })
+
+    def on_compare(self):
+        if not self.items:
+            return
+        path, _ = QFileDialog.getOpenFileName(self, "Comparar con", "", "Archivos (*.json *.txt);;Todos (*.*)")
+        if not path:
+            return
+        # The open document is the newer side; the chosen file classifies with its own ids
+        current = [(d, self.periods.bucket_of(d)) for d in self.items]
+        def compare(worker, path, current):
+            result = open_closing_file(path, worker.report, lambda: worker.cancelled, lazy=True)
+            if result is None:
+                return None
+            if worker.cancelled:
+                return None
+            root, items = result[0], result[1]
+            ids = extract_global_ids(root)
+            return diff_items([(d, classify_period(d, ids) or "dia") for d in items], current)
+        self.run_in_background("Comparando...", compare, lambda entries: self.on_compared(path, entries), path, current, cancellable=True)
+
+    def on_compared(self, path: str, entries: Optional[List[DiffEntry]]):
+        if entries is None:
+            self.current_label.setText("Comparación cancelada")
+            return
+        self.diff = ClosingDiff(path, entries)
+        self.diff_box.setChecked(True)
+        self.update_diff_view()
+        n = self.diff.counts()
+        QMessageBox.information(self, "Comparación", f"Diferencias con {os.path.basename(path)}:\n"
+                                f"{n.get('added', 0)} nuevos, {n.get('removed', 0)} eliminados, "
+                                f"{n.get('moved', 0)} movidos, {n.get('changed', 0)} modificados")
+
+    def visible_diff(self) -> Optional[ClosingDiff]:
+        if self.diff is not None and self.diff_box.isChecked():
+            return self.diff
+        return None
+
+    def update_diff_view(self):
+        self.diff_box.setEnabled(self.diff is not None)
+        diff = self.visible_diff()
+        if diff is not None and diff.removed:
+            # Removed items may lie past the current grid
+            self.ensure_extent(max(r for (r, _), _ in diff.removed) + 1, max(c for (_, c), _ in diff.removed) + 1)
+        for i in range(self.tabs.count()):
+            p = self.tabs.widget(i).property("period")
+            n = sum(diff.counts(p).values()) if diff is not None else 0
+            self.tabs.setTabText(i, f"{self.period_title(p)} ({n})" if n else self.period_title(p))
+        for model in self.models.values():
+            model.refresh_all()
+
+    def on_remap_ids(self):
+        if not self.items:
+            return
+        dlg = IdRemapDialog(id_form_counts(self.periods.buckets), self.global_ids, self)
+        if dlg.exec() != QDialog.Accepted:
+            return
+        maps = dlg.maps()
+        changes = plan_id_remap(self.periods.buckets, maps)
+        ids = remap_global_ids(self.global_ids, maps)
+        if not changes and ids == self.global_ids:
+            return
+        self.save_state()
+        self.remap_ids(changes, ids)
+        self.current_label.setText(f"id_form reasignado en {len(changes)} items")
+        r, c = self.current_cell()
+        if r >= 0 and c >= 0:
+            self.show_cell_details(r, c)
 
     def extract_global_ids(self):
-        ids = {"dia": None, "semana": None, "mes": None, "anio": None}
-        root = self.root_data
-        try:
-            if isinstance(root, dict) and isinstance(root.get("formularioC"), list):
-                arr = root["formularioC"][0]
-                cf = arr.get("cod_fechas", [])
-                for e in cf:
-                    tv = e.get("tipo_val")
-                    if tv == "d":
-                        ids["dia"] = e.get("id_form")
-                    elif tv == "s":
-                        ids["semana"] = e.get("id_form")
-                    elif tv == "m":
-                        ids["mes"] = e.get("id_form")
-                    elif tv == "a":
-                        ids["anio"] = e.get("id_form")
-        except Exception:
-            pass
-        self.global_ids = ids
+        self.global_ids = extract_global_ids(self.root_data)
 
     def apply_global_ids_to_root(self):
-        root = self.root_data
-        try:
-            if isinstance(root, dict) and isinstance(root.get("formularioC"), list):
-                arr = root["formularioC"][0]
-                cf = arr.get("cod_fechas", [])
-                for e in cf:
-                    tv = e.get("tipo_val")
-                    if tv == "d" and self.global_ids.get("dia") is not None:
-                        e["id_form"] = int(self.global_ids["dia"])
-                    elif tv == "s" and self.global_ids.get("semana") is not None:
-                        e["id_form"] = int(self.global_ids["semana"])
-                    elif tv == "m" and self.global_ids.get("mes") is not None:
-                        e["id_form"] = int(self.global_ids["mes"])
-                    elif tv == "a" and self.global_ids.get("anio") is not None:
-                        e["id_form"] = int(self.global_ids["anio"])
-        except Exception:
-            pass
-
-    def update_root_with_items_and_ids(self, root):
+        apply_global_ids(self.root_data, self.global_ids)
+
+    def update_root_with_items_and_ids(self):
+        # Only rows of items edited since the last save are touched
         self.apply_global_ids_to_root()
-        mapping = {d.codigo: d.posicion for d in self.items}
-        def rec(v):
-            if isinstance(v, dict):
-                if "codigo" in v and "posicion" in v:
-                    code = v.get("codigo")
-                    if code in mapping:
-                        v["posicion"] = mapping[code]
-                for k in list(v.keys()):
-                    v[k] = rec(v[k])
-                return v
-            elif isinstance(v, list):
-                return [rec(e) for e in v]
-            else:
-                return v
-        try:
-            return rec(root)
-        except Exception:
-            return [d.__dict__ for d in self.items]
+        self.sources.patch()
+        return self.root_data
+
+    def items_in_band(self, axis: int, start: int, stop: int) -> List[Tuple[CellItem, str]]:
+        # (item, period) pairs whose row (axis 0) or column (axis 1) is in [start, stop)
+        span = (self.groups.max_c if axis == 0 else self.groups.max_r) + 1
+        if (stop - start) * span * len(PERIODS) < len(self.pos_to_item):
+            out = []
+            for k in range(start, stop):
+                for j in range(span):
+                    pos = (k, j) if axis == 0 else (j, k)
+                    for p in PERIODS:
+                        d = self.pos_to_item.get((pos, p))
+                        if d is not None:
+                            out.append((d, p))
+            return out
+        return [(d, p) for (pos, p), d in self.pos_to_item.items() if start <= pos[axis] < stop]
+
+    def delete_lines(self, axis: int, start: int, count: int):
+        self.save_state()
+        band = self.items_in_band(axis, start, start + count)
+        if band:
+            self.remove_items(band)
+        self.shift_positions(axis, start, -count)
+        if hasattr(self, "count_label") and self.count_label:
+            self.count_label.setText(f"{len(self.items)} Items | Cargados")
+
+    def on_delete_row(self):
+        idx, col = self.current_cell()
+        if idx < 0:
+            return
+        self.delete_lines(0, idx, self.span_spin.value())
+        if self.table.model().rowCount() > idx:
+            self.select_cell(idx, col if col >= 0 else 0)
+            self.table.setFocus()
+
+    def on_delete_col(self):
+        row, idx = self.current_cell()
+        if idx < 0:
+            return
+        self.delete_lines(1, idx, self.span_spin.value())
+        if self.table.model().columnCount() > idx:
+            self.select_cell(row if row >= 0 else 0, idx)
+            self.table.setFocus()
 
     def on_insert_row(self):
-        idx = self.table.currentRow()
-        col = self.table.currentColumn()
+        idx, col = self.current_cell()
         if idx < 0:
             return
         self.save_state()
-        updated = []
-        for d in self.items:
-            r, c = parse_pos(d.posicion)
-            if r >= idx:
-                r += 1
-            d.posicion = fmt_pos(r, c)
-            updated.append(d)
-        self.items = updated
-        self.items_by_codigo = {d.codigo: d for d in self.items}
-        
-        self.pos_to_item = {}
-        for d in self.items:
-            p = self.get_period(d) or "dia"
-            self.pos_to_item[(d.posicion, p)] = d
-            
-        self.render_from_items()
+        self.shift_positions(0, idx, self.span_spin.value())
         
         # Restore selection to the same relative position (shifted down)
         # Note: idx was the row BEFORE insertion. The new empty row is at idx.
@@ -1132,52 +2193,27 @@ class GridEditor(QMainWindow):
         # User usually wants to continue working near where they were.
         # Let's select the newly created empty row at the same column.
         
-        # Force table update to ensure rows exist
-        QApplication.processEvents()
-        
-        if self.table.rowCount() > idx:
-            self.table.setCurrentCell(idx, col if col >= 0 else 0)
+        if self.table.model().rowCount() > idx:
+            self.select_cell(idx, col if col >= 0 else 0)
             self.table.setFocus()
 
     def on_insert_col(self):
-        row = self.table.currentRow()
-        idx = self.table.currentColumn()
+        row, idx = self.current_cell()
         if idx < 0:
             return
         self.save_state()
-        updated = []
-        for d in self.items:
-            r, c = parse_pos(d.posicion)
-            if c >= idx:
-                c += 1
-            d.posicion = fmt_pos(r, c)
-            updated.append(d)
-        self.items = updated
-        self.items_by_codigo = {d.codigo: d for d in self.items}
-        
-        self.pos_to_item = {}
-        for d in self.items:
-            p = self.get_period(d) or "dia"
-            self.pos_to_item[(d.posicion, p)] = d
-            
-        self.render_from_items()
+        self.shift_positions(1, idx, self.span_spin.value())
         
         # Restore selection to the newly created column
-        QApplication.processEvents()
-        
-        if self.table.columnCount() > idx:
-            self.table.setCurrentCell(row if row >= 0 else 0, idx)
+        if self.table.model().columnCount() > idx:
+            self.select_cell(row if row >= 0 else 0, idx)
             self.table.setFocus()
 
-    def get_item_at(self, pos: str, period: str) -> Optional[CellItem]:
-        return self.pos_to_item.get((pos, period))
-
-    def on_cell_changed(self, r: int, c: int):
+    def on_cell_changed(self, r: int, c: int, txt: str):
         if self.updating:
             return
-        itm = self.table.item(r, c)
-        txt = itm.text().strip() if itm else ""
-        pos = fmt_pos(r, c)
+        txt = txt.strip()
+        pos = intern_pos(r, c)
         
         # IMPROVED: Direct lookup with period awareness
         existing = self.pos_to_item.get((pos, self.current_period))
@@ -1197,15 +2233,10 @@ class GridEditor(QMainWindow):
             
         if not txt:
             if existing:
-                try:
-                    self.items.remove(existing)
-                except ValueError:
-                    pass
-                self.pos_to_item.pop((pos, self.current_period), None)
-                self.items_by_codigo.pop(existing.codigo, None)
+                self.remove_item(existing, self.current_period)
             return
         if existing:
-            existing.label = txt
+            self.set_item_field(existing, self.current_period, "label", txt)
         else:
             # Determine appropriate ID for the current period
             current_id = 0
@@ -1223,45 +2254,39 @@ class GridEditor(QMainWindow):
                 posicion=pos,
                 valor="",
             )
-            self.items.append(new)
-            self.pos_to_item[(pos, self.current_period)] = new
+            self.add_item(new, self.current_period)
             
             # Sync creation to other periods if they have valid IDs
             # "cuando agregue valores en dia lo agregue en semana mes año pero exactamente igual"
             # "y salgan en rojo hasta que modifique el codigo"
             if current_id > 0: # Only sync if current item has a valid ID context
-                # PREVENT RECURSION: We are about to modify tables programmatically.
-                self.updating = True
-                try:
-                    for p in ["dia", "semana", "mes", "anio"]:
-                        if p == self.current_period:
-                            continue
-                        
-                        target_id = self.global_ids.get(p)
-                        # "si en el dialogo... uno esta vacio... omitira y no hara nada"
-                        if target_id is None:
-                            continue
-                            
-                        # "que se cree en semana pero con su respectivo id de semana y no con el de dia"
-                        clone = copy.deepcopy(new)
-                        clone.id_form = target_id
-                        
-                        self.items.append(clone)
-                        # CRITICAL: Register clone in the map so it doesn't "disappear" or get overwritten
-                        self.pos_to_item[(pos, p)] = clone
-                        
-                        # Force visual creation of the clone in its table so update_duplicates can find it
-                        self.place_item(clone)
-                finally:
-                    self.updating = False
+                self.propagate_items([new], self.current_period)
             
-        self.build_groups()
         self.show_cell_details(r, c)
-        self.update_duplicates()
-        self.refresh_list()
+
+    def propagate_items(self, items: List[CellItem], period: str):
+        """Clone new items of period into every other period with a global id, as one batch."""
+        # "si en el dialogo... uno esta vacio... omitira y no hara nada"
+        targets = [(p, self.global_ids[p]) for p in PERIODS if p != period and self.global_ids.get(p) is not None]
+        # A CD/CS/CM/CA code pins an item to its period whatever its id, so such clones would land back in it
+        items = [d for d in items if not code_period(d.codigo)]
+        if not items or not targets:
+            return
+        # PREVENT RECURSION: We are about to modify tables programmatically.
+        self.updating = True
+        try:
+            with self.batched():
+                for p, target_id in targets:
+                    for d in items:
+                        # "que se cree en semana pero con su respectivo id de semana y no con el de dia"
+                        clone = copy.copy(d)
+                        clone.id_form = target_id
+                        self.add_item(clone, p)
+        finally:
+            self.updating = False
 
     def show_cell_details(self, r: int, c: int):
-        pos = fmt_pos(r, c)
+        pos = (r, c)
         
         # IMPROVED: Find item strictly for the current period
         it = self.pos_to_item.get((pos, self.current_period))
@@ -1269,7 +2294,7 @@ class GridEditor(QMainWindow):
         if it:
             self.det_label.setText(it.label)
             self.det_codigo.setText(it.codigo)
-            self.det_posicion.setText(it.posicion)
+            self.det_posicion.setText(fmt_pos(*it.posicion))
             self.det_id.setText(str(it.id_form))
             self.det_tipo.setText(str(it.tipo))
             self.det_deci.setText(str(it.deci))
@@ -1277,7 +2302,7 @@ class GridEditor(QMainWindow):
         else:
             self.det_label.setText("")
             self.det_codigo.setText("")
-            self.det_posicion.setText(f"{r}:{c}")
+            self.det_posicion.setText(fmt_pos(r, c))
             self.det_id.setText("")
             self.det_tipo.setText("")
             self.det_deci.setText("")
@@ -1285,12 +2310,11 @@ class GridEditor(QMainWindow):
             
     def on_detail_edited(self):
         if self.updating: return
-        r = self.table.currentRow()
-        c = self.table.currentColumn()
+        r, c = self.current_cell()
         if r < 0 or c < 0:
             return
         
-        pos = fmt_pos(r, c)
+        pos = intern_pos(r, c)
         
         # IMPROVED: Find item strictly for the current period
         item = self.pos_to_item.get((pos, self.current_period))
@@ -1325,23 +2349,8 @@ class GridEditor(QMainWindow):
                 posicion=pos,
                 valor=new_valor
             )
-            self.items.append(item)
-            # Only update pos_to_item if it's the first item at this pos (or force it?)
-            # For multi-period support, pos_to_item is ambiguous.
-            # But we set it for legacy support.
-            self.pos_to_item[(pos, self.current_period)] = item
+            self.add_item(item, self.current_period)
             
-            if new_code:
-                self.items_by_codigo[new_code] = item
-            
-            self.updating = True
-            qitem = QTableWidgetItem(new_label)
-            qitem.setData(Qt.UserRole, new_code)
-            self.table.setItem(r, c, qitem)
-            self.updating = False
-            
-            self.build_groups() # Rebuild groups for the new item
-            self.refresh_list()
             self.current_label.setText(f"Cargados: {len(self.items)} items")
             if hasattr(self, "count_label") and self.count_label:
                 self.count_label.setText(f"{len(self.items)} Items | Cargados")
@@ -1360,58 +2369,48 @@ class GridEditor(QMainWindow):
         # DISABLE SIBLING SYNC - items are independent after creation
         # siblings = [] ...
         
-        old_code = item.codigo
-        if old_code != new_code:
-            if old_code in self.items_by_codigo:
-                del self.items_by_codigo[old_code]
-            if new_code:
-                self.items_by_codigo[new_code] = item
-        
         # Update the main item
-        item.label = new_label
-        item.codigo = new_code
-        item.id_form = new_id
-        item.tipo = new_tipo
-        item.deci = new_deci
-        item.valor = new_valor
+        p = self.current_period
+        self.set_item_field(item, p, "label", new_label)
+        self.set_item_field(item, p, "codigo", new_code)
+        self.set_item_field(item, p, "id_form", new_id)
+        self.set_item_field(item, p, "tipo", new_tipo)
+        self.set_item_field(item, p, "deci", new_deci)
+        self.set_item_field(item, p, "valor", new_valor)
         
         # DISABLED SIBLING UPDATE LOOP
         # for sib in siblings: ...
-        
-        self.updating = True
-        qitem = self.table.item(r, c)
-        if not qitem:
-            qitem = QTableWidgetItem(new_label)
-            self.table.setItem(r, c, qitem)
-        else:
-            qitem.setText(new_label)
-            qitem.setData(Qt.UserRole, new_code)
-        self.updating = False
-        
-        self.build_groups() # Rebuild groups as label might have changed
-        self.refresh_list()
-        self.update_duplicates()
 
     def on_clear_all(self):
         self.save_state()
-        self.items = []
-        self.items_by_codigo = {}
-        self.pos_to_item = {}
-        self.groups = {}
-        for tbl in self.tables.values():
-            tbl.clearContents()
-            tbl.setRowCount(0)
-            tbl.setColumnCount(0)
-        self.list.clear()
+        self.history.record(("clear", self.items, self.pos_to_item))
+        self._clear_items()
         self.current_label.setText("Cargados: 0 items")
         if hasattr(self, "count_label") and self.count_label:
             self.count_label.setText("0 Items | Cargados")
 
+    def _clear_items(self):
+        for d in self.items:
+            self.sources.mark(d, live=False)
+        self.items = []
+        self.items_by_codigo = {}
+        self.pos_to_item = {}
+        self.groups.clear()
+        self.dups.clear()
+        self.periods.clear()
+        self.search.clear()
+        self.list_model.set_items([])
+        for model in self.models.values():
+            model.reset_extent(0, 0)
+
 def main():
+    # CIERRES_PROFILE=1 measures from startup, so the first load is included
+    PROFILER.enabled = bool(os.environ.get("CIERRES_PROFILE"))
     app = QApplication(sys.argv)
     w = GridEditor()
     w.resize(1200, 700)
     w.show()
+    QTimer.singleShot(0, w.check_recovery)
     sys.exit(app.exec())
 
 if __name__ == "__main__":
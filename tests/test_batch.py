@@ -0,0 +1,46 @@
+import json
+import os
+
+import pytest
+
+from batch import collect_inputs, output_names, run_batch
+
+def closing_file(path, valor: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    row = {"id_form": 101, "label": "VENTA DIA", "codigo": "CD1", "tipo": 1, "deci": 0, "posicion": "0:0", "valor": valor}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"datosAG": [[row]]}, f)
+
+def test_output_names_keep_colliding_paths(tmp_path):
+    a, b, c = str(tmp_path / "a" / "cierre.json"), str(tmp_path / "b" / "cierre.json"), str(tmp_path / "a" / "otro.json")
+    assert output_names([a, b, c]) == {a: os.path.join("a", "cierre.json"), b: os.path.join("b", "cierre.json"), c: "otro.json"}
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_same_name_inputs_do_not_overwrite(tmp_path, jobs):
+    a, b = str(tmp_path / "a" / "cierre.json"), str(tmp_path / "b" / "cierre.json")
+    closing_file(a, "A")
+    closing_file(b, "B")
+    out = tmp_path / "out"
+    files = collect_inputs([a, b, a])
+    assert files == [a, b]
+    reports = run_batch(files, str(out), {"dia": 101}, jobs=jobs)
+    assert [r.get("error") for r in reports] == [None, None]
+    assert len({r["output"] for r in reports}) == 2
+    for r, valor in zip(reports, "AB"):
+        with open(r["output"], encoding="utf-8") as f:
+            assert json.load(f)["datosAG"][0][0]["valor"] == valor
+
+def test_output_names_without_common_dir(tmp_path, monkeypatch):
+    # As on Windows, for inputs on different drives
+    def no_common(paths):
+        raise ValueError("Paths don't have the same drive")
+    monkeypatch.setattr(os.path, "commonpath", no_common)
+    a, b = str(tmp_path / "a" / "cierre.json"), str(tmp_path / "b" / "cierre.json")
+    closing_file(a, "A")
+    closing_file(b, "B")
+    names = output_names([a, b])
+    assert len(set(names.values())) == 2
+    assert all(os.path.dirname(n) == "" and n.startswith("cierre-") and n.endswith(".json") for n in names.values())
+    reports = run_batch([a, b], str(tmp_path / "out"), {"dia": 101})
+    assert [r.get("error") for r in reports] == [None, None]
+    assert [os.path.basename(r["output"]) for r in reports] == [names[a], names[b]]
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+from core import load_closing_file, write_closing_file, LazyDocument, SourceIndex, PeriodIndex, classify_period
+
+ROW = {"id_form": 101, "label": "VENTA DIA", "codigo": "CD1", "tipo": 1, "deci": 0, "posicion": "2:3", "valor": "10"}
+
+def write(tmp_path, name: str, text: str) -> str:
+    path = tmp_path / name
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+def index_sources(root, items, paths, doc=None) -> SourceIndex:
+    periods = PeriodIndex(lambda d: classify_period(d, {}))
+    periods.rebuild(items)
+    sources = SourceIndex()
+    sources.build(root, items, paths, [periods.bucket_of(d) for d in items], doc)
+    return sources
+
+@pytest.mark.parametrize("name, text", [
+    ("one.json", json.dumps(dict(ROW, extra="keep"))),
+    ("one.jsonl", json.dumps(dict(ROW, extra="keep")) + "\n"),
+])
+@pytest.mark.parametrize("lazy", [False, True])
+def test_single_row_document(tmp_path, name, text, lazy):
+    path = write(tmp_path, name, text)
+    root, items, paths, jsonl = load_closing_file(path, lazy=lazy)
+    assert [(d.codigo, d.posicion, d.valor) for d in items] == [("CD1", (2, 3), "10")]
+    assert paths == [()]
+    doc = LazyDocument(path) if lazy else None
+    sources = index_sources(root, items, paths, doc)
+    assert sources.ordered_items(root) == items
+    items[0].valor = "20"
+    sources.mark(items[0])
+    assert sources.can_patch()
+    assert sources.patch() == 1
+    out = str(tmp_path / "out.json")
+    write_closing_file(out, root, jsonl, doc)
+    with open(out, encoding="utf-8") as f:
+        assert json.load(f) == dict(ROW, extra="keep", valor="20")
+    if doc is not None:
+        doc.close()
+
+def test_single_row_document_cannot_drop_root(tmp_path):
+    path = write(tmp_path, "one.json", json.dumps(ROW))
+    root, items, paths, _ = load_closing_file(path)
+    sources = index_sources(root, items, paths)
+    sources.mark(items[0], live=False)
+    assert not sources.can_patch()
+    sources.patch()
+    assert root == ROW
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_empty_file(tmp_path, lazy):
+    path = write(tmp_path, "empty.json", "")
+    root, items, paths, jsonl = load_closing_file(path, lazy=lazy)
+    assert (root, items, paths, jsonl) == ([], [], [], False)
+
+@pytest.mark.parametrize("text", [
+    "[1 2]",
+    "[1,]",
+    "[,1]",
+    '{"a":1}{"b":2}',
+    '{"a":1},{"b":2}',
+    '[{"a":1}{"b":2}]',
+    '[{"a":1},{"b":2},]',
+    '{"a" 1}',
+    '{"a":1,}',
+    '{"a":}',
+    '{"a"}',
+    '{1:2}',
+    '{"a":1:2}',
+    '[1:2]',
+    ':',
+    '[1]]',
+    '{"a":[1}',
+    '{"a":{"b":1},{"c":2}}',
+])
+@pytest.mark.parametrize("lazy", [False, True])
+def test_invalid_json(tmp_path, text, lazy):
+    path = write(tmp_path, "bad.json", text)
+    with pytest.raises(ValueError):
+        load_closing_file(path, lazy=lazy)
+
+@pytest.mark.parametrize("text", [
+    "[]", "{}", "[[], {}]", '{"a": [1, {"b": null}], "c": "x"}',
+    '{"a":1}\n{"b":2}\n', '[1]\n[2]', "1\n2",
+])
+def test_valid_json(tmp_path, text):
+    path = write(tmp_path, "ok.json", text)
+    root, _, _, _ = load_closing_file(path)
+    lines = text.strip().splitlines()
+    assert root == (json.loads(text) if len(lines) == 1 else [json.loads(l) for l in lines])
+
+@pytest.mark.parametrize("ag", [[], [[]], [[], [1, "x"]]])
+def test_row_free_datosag_loads_like_eager(tmp_path, ag):
+    doc = {"formularioC": [{"cod_fechas": [{"tipo_val": "d", "id_form": 101}], "plantilla": ROW}], "datosAG": ag}
+    path = write(tmp_path, "ag.json", json.dumps(doc))
+    eager = load_closing_file(path)
+    lazy = load_closing_file(path, lazy=True)
+    assert eager[1] == lazy[1] == []
+    assert eager[2] == lazy[2] == []
@@ -0,0 +1,93 @@
+import json
+import os
+import time
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+QtWidgets = pytest.importorskip("PySide6.QtWidgets")
+from PySide6.QtCore import QItemSelection, QItemSelectionModel
+
+import main as editor
+from core import PERIODS, JOURNAL_VERSION, journal_dir
+
+IDS = {"dia": 101, "semana": 102, "mes": 103, "anio": 104}
+TIPO_VAL = {"dia": "d", "semana": "s", "mes": "m", "anio": "a"}
+
+@pytest.fixture(scope="module")
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+@pytest.fixture
+def open_editor(app, tmp_path, monkeypatch):
+    monkeypatch.setenv("CIERRESMAKER_CACHE_DIR", str(tmp_path / "cache"))
+    opened = []
+    def open_editor(path: str, save_path: str = ""):
+        monkeypatch.setattr(QtWidgets.QFileDialog, "getOpenFileName", staticmethod(lambda *a, **k: (path, "")))
+        monkeypatch.setattr(QtWidgets.QFileDialog, "getSaveFileName", staticmethod(lambda *a, **k: (save_path, "")))
+        monkeypatch.setattr(QtWidgets.QMessageBox, "information", staticmethod(lambda *a, **k: None))
+        w = editor.GridEditor()
+        # Keep every item; the ids come from the file
+        w.ask_global_ids = lambda: False
+        opened.append(w)
+        w.on_load_json()
+        wait_idle(app, w)
+        return w
+    yield open_editor
+    for w in opened:
+        w.close()
+
+def wait_idle(app, w):
+    while w.busy:
+        app.processEvents()
+        time.sleep(0.001)
+    app.processEvents()
+
+def closing_file(path, rows):
+    doc = {
+        "formularioC": [{"nombre": "t", "cod_fechas": [{"tipo_val": TIPO_VAL[p], "id_form": IDS[p]} for p in PERIODS]}],
+        "datosAG": [[dict(id_form=IDS["dia"], tipo=1, deci=0, valor="", **row) for row in rows]],
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(doc, f)
+
+def cells(w):
+    return sorted((pos, p, d.codigo, d.label, d.id_form, w.get_period(d)) for (pos, p), d in w.pos_to_item.items())
+
+def test_paste_propagates_only_uncoded_cells(app, open_editor, tmp_path):
+    src, out = str(tmp_path / "in.json"), str(tmp_path / "out.json")
+    closing_file(src, [{"label": "VENTA", "codigo": "CD0", "posicion": "0:0"},
+                       {"label": "NOTA", "codigo": "", "posicion": "0:1"},
+                       # Stretches the grid over the paste target
+                       {"label": "FIN", "codigo": "CD9", "posicion": "5:5"}])
+    w = open_editor(src, out)
+    w.select_cell(0, 0)
+    model = w.table.model()
+    w.table.selectionModel().select(QItemSelection(model.index(0, 0), model.index(0, 1)), QItemSelectionModel.ClearAndSelect)
+    w.copy_selection()
+    w.select_cell(4, 2)
+    w.paste_selection()
+    pasted = [x for x in cells(w) if x[0] == (4, 2) or x[0] == (4, 3)]
+    # The coded cell stays in its period; the uncoded one reaches every sheet with that sheet's id
+    assert pasted == sorted([((4, 2), "dia", "CD0", "VENTA", 101, "dia")] +
+                            [((4, 3), p, "", "NOTA", IDS[p], p) for p in PERIODS])
+    # Only the pasted copy repeats the original's code
+    assert len(w.dups.by_code["CD0"]) == 2
+    w.on_save_json()
+    wait_idle(app, w)
+    before = cells(w)
+    assert cells(open_editor(out)) == before
+
+def test_recovery_drops_header_only_journals(app, tmp_path, monkeypatch):
+    monkeypatch.setenv("CIERRESMAKER_CACHE_DIR", str(tmp_path / "cache"))
+    asked = []
+    monkeypatch.setattr(QtWidgets.QMessageBox, "question", staticmethod(lambda *a, **k: asked.append(a) or QtWidgets.QMessageBox.No))
+    os.makedirs(journal_dir())
+    path = os.path.join(journal_dir(), "vacio.journal")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(["journal", JOURNAL_VERSION, {"source": str(tmp_path / "in.json")}]) + "\n")
+    w = editor.GridEditor()
+    w.check_recovery()
+    w.close()
+    assert not os.path.exists(path)
+    assert asked == []